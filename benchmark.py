@@ -0,0 +1,133 @@
+import configparser
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from components.Instrumentation import Instrumentation
+from components.LogGenerator import LogGenerator
+from components.LogLoader import LogLoader
+from components.ModelExtractor import ModelExtractor
+from components.ModelValidator import ModelValidator, GROUND_TRUTH_KPIS
+from components.ModelManipulator import ModelManipulator
+
+#synthetic lines of growing size, see components/LogGenerator.py
+SIZES = [
+    {"n_stations": 2, "n_agvs": 2, "n_orders": 5000},
+    {"n_stations": 2, "n_agvs": 2, "n_orders": 20000},
+    {"n_stations": 4, "n_agvs": 2, "n_orders": 50000},
+    {"n_stations": 8, "n_agvs": 4, "n_orders": 100000},
+]
+
+TIME = 1440
+NR_REPLICATIONS = 10
+BACKEND = "spn"
+OUTPUT_DIR = "output/benchmark/"
+
+def measure(results, size, stage, function, *args, trace=False, **kwargs):
+    """Run function(*args, **kwargs) and append its wall time, or with trace its peak traced memory (in-process only, workers
+    are not traced), to results. tracemalloc slows Python-heavy stages down several times, so both are measured in separate
+    passes. Returns the function's return value."""
+
+    if trace == True:
+        tracemalloc.start()
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    if trace == True:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({**size, "stage": stage, "peak_mb": peak / 2**20})
+        print("{}: {} {:.1f} MB".format(size, stage, peak / 2**20))
+    else:
+        results.append({**size, "stage": stage, "seconds": seconds})
+        print("{}: {} {:.2f} s".format(size, stage, seconds))
+
+    return value
+
+def benchmark_config(generator):
+    #fits are not cached, otherwise repeated benchmarks would only time cache reads
+    config = configparser.ConfigParser()
+    config.read('cs_two_station.ini')
+    config.remove_option("DISTRIBUTIONS", "fit_cache_dir")
+    config.remove_section("CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS")
+    config.add_section("CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS")
+    for enter, leave in generator.capacity_relationships().items():
+        config.set("CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS", enter, leave)
+    return config
+
+def benchmark_size(size, log_dir, trace=False):
+    """One pass of the pipeline on a generated line of size. Returns the measured stages and the instrumentation summary."""
+
+    results = []
+
+    #----generate & load logs----#
+    generator = LogGenerator(**size, seed=1)
+    event_log_path, state_log_path = measure(results, size, "generate", generator.write, log_dir, trace=trace)
+    event_log_unseen_path, state_log_unseen_path = LogGenerator(**size, seed=2).write(log_dir, suffix="_unseen")
+
+    #the logs are written again by every pass, so their cache entries are new and every pass loads from csv
+    loader = LogLoader(cache_dir=os.path.join(log_dir, "cache"))
+    event_log = measure(results, size, "load event log", loader.load_event_log, event_log_path, trace=trace)
+    state_log = measure(results, size, "load state log", loader.load_state_log, state_log_path, trace=trace)
+    event_log_unseen = loader.load_event_log(event_log_unseen_path)
+    state_log_unseen = loader.load_state_log(state_log_unseen_path)
+
+    #stage timers of the pipeline itself (alpha mining, fits, replications, ...), progress messages are not printed
+    instrumentation = Instrumentation(sinks=[])
+
+    #----extraction----#
+    mg = ModelExtractor(event_log, state_log, benchmark_config(generator), instrumentation=instrumentation)
+    rel_model = measure(results, size, "extract_model", mg.extract_model, trace=trace)
+
+    #----ground truth & validation----#
+    mv = ModelValidator(rel_model, "m", event_log, state_log, event_log_unseen, state_log_unseen, seed=42, backend=BACKEND, instrumentation=instrumentation)
+    for kpi in GROUND_TRUTH_KPIS:
+        measure(results, size, "calculate_ground_truth " + kpi, mv.calculate_ground_truth, TIME, kpi, event_log, state_log, trace=trace)
+    measure(results, size, "validate_model", mv.validate_model, nr_replications=NR_REPLICATIONS, time=TIME, results_transition="order_completed", kpi="production volume", trace=trace)
+    mv.close()
+
+    #----manipulation----#
+    resources_repair = [transition.label for transition in rel_model.transitions if transition.label.startswith("repair_")]
+    mm = ModelManipulator(rel_model, time_unit="m", seed=42, backend=BACKEND, instrumentation=instrumentation)
+    measure(results, size, "manipulate_model", mm.manipulate_model, "order_completed", "production volume", nr_replications=NR_REPLICATIONS, time=TIME, transitions_to_manipulate_dynamic=resources_repair, handicap_range_dynamic=[1.0,2.0], step_dynamic=0.5, type_dynamic="decrease", trace=trace)
+    mm.close()
+
+    for result in results:
+        result.update({"n_events": len(event_log), "n_states": len(state_log)})
+
+    return results, instrumentation.summary()
+
+def run_benchmark(sizes=SIZES, output_dir=OUTPUT_DIR, memory=True):
+    """Time every stage on every size, then, if memory, run the pipeline again with tracemalloc for the peak memory per stage."""
+
+    results = []
+    summaries = []
+
+    for size in sizes:
+        log_dir = os.path.join(output_dir, "logs", "_".join("{}{}".format(key[len("n_"):], value) for key, value in size.items()))
+
+        timed, summary = benchmark_size(size, log_dir)
+        if memory == True:
+            traced, _ = benchmark_size(size, log_dir, trace=True)
+            for result, traced_result in zip(timed, traced):
+                result["peak_mb"] = traced_result["peak_mb"]
+
+        results += timed
+        summaries.append({**size, **summary})
+
+    #machine-readable results, one file per benchmark run
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, "benchmark_{}.json".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+    with open(path, "w") as f:
+        json.dump({"timestamp": datetime.now().isoformat(), "python": sys.version, "platform": platform.platform(), "time": TIME, "nr_replications": NR_REPLICATIONS, "backend": BACKEND, "results": results, "stages": summaries}, f, indent=2)
+    print("Results written to {}".format(path))
+
+    return results
+
+if __name__ == "__main__":
+    run_benchmark()
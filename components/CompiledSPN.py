@@ -0,0 +1,329 @@
+import numpy as np
+import scipy.stats as st
+
+from pyspn.components import spn
+
+from components.KPI import label_index
+
+TIME_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+#distributions whose scaling about loc only changes the scale parameter, the biased distribution keeps the shape
+IMPORTANCE_SAMPLING_DISTRIBUTIONS = ["expon", "weibull_min", "gamma"]
+
+class CompiledSPN:
+    """Array form of an SPN for batched simulation: pre/post/inhibitor incidence matrices (transitions x places), transition types,
+    firing weights, frozen delay distributions and the initial marking. Transitions and places are indexed in the order of
+    rel_model.transitions and rel_model.places. Handicaps and delay time units are folded into delay_factor.
+
+    bias {transition label: scale} turns on importance sampling: delays of these transitions are drawn from their distribution
+    with the scale parameter multiplied by scale (< 1 makes e.g. failures more frequent) and every replication gets the likelihood
+    ratio of its path. Only the distributions of IMPORTANCE_SAMPLING_DISTRIBUTIONS can be biased.
+    """
+
+    def __init__(self, rel_model:spn.SPN, time_unit, bias=None):
+
+        self.place_labels = [place.label for place in rel_model.places]
+        self.transition_labels = [transition.label for transition in rel_model.transitions]
+        place_index = {id(place): p for p, place in enumerate(rel_model.places)}
+
+        n_transitions = len(rel_model.transitions)
+        n_places = len(rel_model.places)
+
+        self.pre = np.zeros((n_transitions, n_places), dtype=np.int64)
+        self.post = np.zeros((n_transitions, n_places), dtype=np.int64)
+        self.inhibitor = np.zeros((n_transitions, n_places), dtype=np.int64)
+        self.timed = np.zeros(n_transitions, dtype=bool)
+        self.weights = np.zeros(n_transitions, dtype=np.float64)
+        self.delay_factor = np.ones(n_transitions, dtype=np.float64)
+        self.distributions = [None]*n_transitions
+
+        for t, transition in enumerate(rel_model.transitions):
+            for arc in transition.input_arcs:
+                self.pre[t, place_index[id(arc.from_place)]] += arc.multiplicity
+            for arc in transition.output_arcs:
+                self.post[t, place_index[id(arc.to_place)]] += arc.multiplicity
+            for arc in transition.inhibitor_arcs:
+                p = place_index[id(arc.from_place)]
+                #several inhibitor arcs from one place: the smallest multiplicity inhibits first
+                self.inhibitor[t, p] = arc.multiplicity if self.inhibitor[t, p] == 0 else min(self.inhibitor[t, p], arc.multiplicity)
+
+            match transition.t_type:
+                case "I":
+                    self.weights[t] = transition.weight
+                case "T":
+                    if transition.distribution == None:
+                        raise Exception("Timed transition without distribution: {}.".format(transition.label))
+                    self.timed[t] = True
+                    dist_name, params = list(transition.distribution.items())[0]
+                    self.distributions[t] = getattr(st, dist_name)(**params)
+                    self.delay_factor[t] = _handicap_factor(transition) * _time_unit_factor(transition.time_unit, time_unit)
+                case _:
+                    raise Exception("Transition type undefined: {}.".format(transition.t_type))
+
+        self.bias = np.ones(n_transitions, dtype=np.float64)
+        self.bias_origin = np.zeros(n_transitions, dtype=np.float64)
+        if bias != None:
+            transition_index = label_index(rel_model.transitions)
+            for label, scale in bias.items():
+                if label not in transition_index:
+                    raise Exception("Transition of importance sampling bias not in model: {}.".format(label))
+                t = transition_index[label]
+                if not self.timed[t]:
+                    raise Exception("Importance sampling bias on immediate transition: {}.".format(label))
+                #scaling other distributions about their support changes their shape (e.g. norm) or support (e.g. uniform), every
+                #biased draw then costs a large part of the replication's weight
+                if self.distributions[t].dist.name not in IMPORTANCE_SAMPLING_DISTRIBUTIONS:
+                    raise Exception("Importance sampling bias on a {} distribution, only {} are supported: {}.".format(self.distributions[t].dist.name, ", ".join(IMPORTANCE_SAMPLING_DISTRIBUTIONS), label))
+                self.bias[t] = scale
+                self.bias_origin[t] = self.distributions[t].support()[0]
+        self.biased = self.bias != 1.0
+
+        self.immediate = ~self.timed
+        self.initial_marking = np.array([place.n_tokens for place in rel_model.places], dtype=np.int64)
+        self.change = self.post - self.pre
+
+        #arc lists for the enabling test, the incidence of arc a on its transition as a (arcs x transitions) matrix
+        in_t, in_p = np.nonzero(self.pre)
+        self._in_p = in_p
+        self._in_m = self.pre[in_t, in_p]
+        self._in_incidence = np.eye(n_transitions)[in_t]
+        self._n_in = self._in_incidence.sum(axis=0)
+
+        inh_t, inh_p = np.nonzero(self.inhibitor)
+        self._inh_p = inh_p
+        self._inh_m = self.inhibitor[inh_t, inh_p]
+        self._inh_incidence = np.eye(n_transitions)[inh_t]
+
+    def enabled(self, marking):
+        """Enabled transitions (replications x transitions) for a marking of shape (replications x places)."""
+        enabled = (marking[:, self._in_p] >= self._in_m) @ self._in_incidence == self._n_in
+        if len(self._inh_p) > 0:
+            enabled &= (marking[:, self._inh_p] >= self._inh_m) @ self._inh_incidence == 0
+        return enabled
+
+    def simulate(self, seeds, max_time, checkpoints=None):
+        """Simulate one independent replication per seed from the initial marking up to max_time in lockstep, one event of
+        every unfinished replication per step. Every replication draws the delays of every transition and its immediate choices
+        from streams of its own seed (see _Streams), so it only depends on its seed, not on the other replications, and runs with
+        the same seed share the random numbers of every transition (common random numbers). Immediate transitions fire first, chosen by weight; timed transitions race with
+        enabling memory like spn_simulate. Returns {counter: array} with n_times_fired and time_enabled (replications x transitions)
+        and time_non_empty and total_tokens (replications x places), and likelihood_ratio (replications) of every path under the
+        biased delays (all ones without bias). Multiplying a replication's KPIs by its likelihood ratio gives unbiased estimates.
+
+        With an increasing array of checkpoints (<= max_time), the counters accumulated up to every checkpoint are returned
+        instead, with shape (replications x checkpoints x transitions/places). Events at a checkpoint count after it.
+        """
+
+        n_transitions = len(self.transition_labels)
+        n_places = len(self.place_labels)
+        nr_replications = len(seeds)
+        #delays are drawn by inversion of the uniforms, the immediate choices use the last stream
+        streams = _Streams(seeds, [None if distribution == None else distribution.ppf for distribution in self.distributions] + [None])
+
+        marking = np.tile(self.initial_marking, (nr_replications, 1))
+        now = np.zeros(nr_replications)
+        clock = np.full((nr_replications, n_transitions), np.inf)
+        active = np.ones(nr_replications, dtype=bool)
+
+        n_times_fired = np.zeros((nr_replications, n_transitions), dtype=np.int64)
+        time_enabled = np.zeros((nr_replications, n_transitions))
+        time_non_empty = np.zeros((nr_replications, n_places))
+        total_tokens = np.zeros((nr_replications, n_places), dtype=np.int64)
+
+        #importance sampling: raw draw and start of every pending clock, log likelihood ratio of every replication
+        importance_sampling = self.biased.any()
+        draws = np.zeros((nr_replications, n_transitions))
+        clock_start = np.zeros((nr_replications, n_transitions))
+        log_ratio = np.zeros(nr_replications)
+
+        record_checkpoints = checkpoints is not None
+        if record_checkpoints:
+            if importance_sampling:
+                raise Exception("Checkpoints are not supported with importance sampling.")
+            checkpoints = np.asarray(checkpoints, dtype=np.float64)
+            next_checkpoint = np.zeros(nr_replications, dtype=np.int64)
+            snapshots = {"n_times_fired": np.zeros((nr_replications, len(checkpoints), n_transitions), dtype=np.int64),
+                         "time_enabled": np.zeros((nr_replications, len(checkpoints), n_transitions)),
+                         "time_non_empty": np.zeros((nr_replications, len(checkpoints), n_places)),
+                         "total_tokens": np.zeros((nr_replications, len(checkpoints), n_places), dtype=np.int64)}
+
+        while active.any():
+            rows = np.flatnonzero(active)
+            enabled = self.enabled(marking[rows])
+
+            #----vanishing markings: fire one immediate transition, chosen by weight----#
+            enabled_immediate = enabled & self.immediate
+            vanishing = enabled_immediate.any(axis=1)
+            if vanishing.any():
+                w = np.where(enabled_immediate[vanishing], self.weights, 0.0)
+                w = np.where(w.sum(axis=1, keepdims=True) > 0, w, enabled_immediate[vanishing])
+                cumulative = np.cumsum(w, axis=1)
+                u = streams.draw(rows[vanishing], n_transitions) * cumulative[:, -1]
+                fire = (cumulative > u[:, None]).argmax(axis=1)
+                self._fire(rows[vanishing], fire, marking, n_times_fired, total_tokens)
+
+            #----tangible markings: advance to the next timed transition----#
+            tangible = ~vanishing
+            if not tangible.any():
+                continue
+            rows = rows[tangible]
+            enabled_timed = enabled[tangible] & self.timed
+
+            clocks = clock[rows]
+            if importance_sampling:
+                #a disabled clock only tells that its delay was longer than the time it was enabled
+                log_ratio[rows] += self._censored_log_ratio(rows, ~enabled_timed & np.isfinite(clocks), now[rows], clock_start, draws)
+            clocks[~enabled_timed] = np.inf
+            newly_enabled = enabled_timed & np.isinf(clocks)
+            for t in np.flatnonzero(newly_enabled.any(axis=0)):
+                k = newly_enabled[:, t]
+                x = streams.draw(rows[k], t)
+                if self.biased[t]:
+                    draws[rows[k], t] = self.draws(t, x)
+                    clock_start[rows[k], t] = now[rows][k]
+                    clocks[k, t] = now[rows][k] + np.maximum(draws[rows[k], t], 0) * self.delay_factor[t]
+                else:
+                    clocks[k, t] = now[rows][k] + self.delays(t, x)
+
+            fire = clocks.argmin(axis=1)
+            firing_time = clocks[np.arange(len(rows)), fire]
+            dead = np.isinf(firing_time)
+            next_time = np.where(dead, now[rows], np.minimum(firing_time, max_time))
+            dt = next_time - now[rows]
+
+            #record every checkpoint passed by this step, interpolating the time counters
+            while record_checkpoints:
+                crossing = np.flatnonzero(next_checkpoint[rows] < len(checkpoints))
+                crossing = crossing[checkpoints[next_checkpoint[rows[crossing]]] <= next_time[crossing]]
+                if len(crossing) == 0:
+                    break
+                r = rows[crossing]
+                c = next_checkpoint[r]
+                elapsed = (checkpoints[c] - now[r])[:, None]
+                snapshots["n_times_fired"][r, c] = n_times_fired[r]
+                snapshots["time_enabled"][r, c] = time_enabled[r] + np.isfinite(clocks[crossing]) * elapsed
+                snapshots["time_non_empty"][r, c] = time_non_empty[r] + (marking[r] > 0) * elapsed
+                snapshots["total_tokens"][r, c] = total_tokens[r]
+                next_checkpoint[r] += 1
+
+            time_enabled[rows] += np.isfinite(clocks) * dt[:, None]
+            time_non_empty[rows] += (marking[rows] > 0) * dt[:, None]
+            now[rows] = next_time
+
+            finished = dead | (next_time >= max_time)
+            firing = ~finished
+
+            if importance_sampling:
+                log_ratio[rows[firing]] += self._fired_log_ratio(rows[firing], fire[firing], draws)
+                #clocks still pending at max_time are censored there
+                log_ratio[rows[finished]] += self._censored_log_ratio(rows[finished], np.isfinite(clocks[finished]), now[rows[finished]], clock_start, draws)
+
+            clocks[np.flatnonzero(firing), fire[firing]] = np.inf
+            clock[rows] = clocks
+            active[rows[finished]] = False
+
+            self._fire(rows[firing], fire[firing], marking, n_times_fired, total_tokens)
+
+        if record_checkpoints:
+            #replications without enabled transitions stop early, their counters stay constant
+            counters = {"n_times_fired": n_times_fired, "time_enabled": time_enabled, "time_non_empty": time_non_empty, "total_tokens": total_tokens}
+            for r in range(nr_replications):
+                for name, values in snapshots.items():
+                    values[r, next_checkpoint[r]:] = counters[name][r]
+            return snapshots
+
+        return {"n_times_fired": n_times_fired, "time_enabled": time_enabled, "time_non_empty": time_non_empty, "total_tokens": total_tokens, "likelihood_ratio": np.exp(log_ratio)}
+
+    def delays(self, t, x):
+        return np.maximum(self.draws(t, x), 0) * self.delay_factor[t]
+
+    def draws(self, t, x):
+        #raw draws in the distribution's own unit from draws x of the original distribution, scaled if t is biased
+        origin = self.bias_origin[t]
+        return origin + (x - origin) * self.bias[t]
+
+    def _unbiased(self, t, x):
+        #the draw of the original distribution that the biased draw x was scaled from
+        return self.bias_origin[t] + (x - self.bias_origin[t]) / self.bias[t]
+
+    def _fired_log_ratio(self, rows, fire, draws):
+        #log f(x) / g(x) of the fired clocks' draws x, with g(x) = f(origin + (x - origin) / scale) / scale the biased density
+        log_ratio = np.zeros(len(rows))
+        for t in np.flatnonzero(self.biased):
+            k = fire == t
+            if k.any():
+                x = draws[rows[k], t]
+                log_ratio[k] = self.distributions[t].logpdf(x) - self.distributions[t].logpdf(self._unbiased(t, x)) + np.log(self.bias[t])
+        return log_ratio
+
+    def _censored_log_ratio(self, rows, pending, now, clock_start, draws):
+        #log P_f(X > x) / P_g(X > x) of the pending clocks that are dropped at now, x being the draw elapsed so far
+        log_ratio = np.zeros(len(rows))
+        for t in np.flatnonzero(self.biased):
+            k = pending[:, t] & (now > clock_start[rows, t])
+            if k.any():
+                x = (now[k] - clock_start[rows[k], t]) / self.delay_factor[t]
+                log_ratio[k] += self.distributions[t].logsf(x) - self.distributions[t].logsf(self._unbiased(t, x))
+        return log_ratio
+
+    def _fire(self, rows, fire, marking, n_times_fired, total_tokens):
+        marking[rows] += self.change[fire]
+        total_tokens[rows] += self.post[fire]
+        n_times_fired[rows, fire] += 1
+
+    def write_counters(self, rel_model:spn.SPN, counters, replication):
+        """Store the counters of one replication on the transitions and places of rel_model, as spn_simulate would have."""
+        for t, transition in enumerate(rel_model.transitions):
+            transition.n_times_fired = int(counters["n_times_fired"][replication, t])
+            transition.time_enabled = float(counters["time_enabled"][replication, t])
+        for p, place in enumerate(rel_model.places):
+            place.time_non_empty = float(counters["time_non_empty"][replication, p])
+            place.total_tokens = int(counters["total_tokens"][replication, p])
+
+class _Streams:
+    """Random numbers of one stream per replication and source (a transition's delays, or the immediate choices), seeded by
+    the replication's seed and the source only and drawn in blocks of BLOCK_SIZE. A replication thus consumes the same numbers
+    for the same transitions whatever the other replications of the batch or its other transitions do. transforms[source]
+    (e.g. a ppf) is applied to every block of uniforms, None keeps them uniform."""
+
+    BLOCK_SIZE = 64
+
+    def __init__(self, seeds, transforms):
+        self.seeds = [int(seed) for seed in seeds]
+        self.transforms = transforms
+        self.generators = {}
+        self.buffer = np.zeros((len(seeds), len(transforms), self.BLOCK_SIZE))
+        self.position = np.full((len(seeds), len(transforms)), self.BLOCK_SIZE)
+
+    def draw(self, rows, source):
+        """Next number of source for each of the distinct replications rows."""
+        empty = rows[self.position[rows, source] == self.BLOCK_SIZE]
+        if len(empty) > 0:
+            u = np.empty((len(empty), self.BLOCK_SIZE))
+            for i, r in enumerate(empty):
+                if (r, source) not in self.generators:
+                    self.generators[(r, source)] = np.random.default_rng(np.random.SeedSequence(self.seeds[r], spawn_key=(source,)))
+                u[i] = self.generators[(r, source)].random(self.BLOCK_SIZE)
+            #one transform for all refilled replications
+            self.buffer[empty, source] = u if self.transforms[source] == None else self.transforms[source](u)
+            self.position[empty, source] = 0
+        x = self.buffer[rows, source, self.position[rows, source]]
+        self.position[rows, source] += 1
+        return x
+
+def _handicap_factor(transition):
+    match transition.handicap_type:
+        case "increase":
+            return transition.handicap
+        case "decrease":
+            return 1 / transition.handicap
+        case _:
+            return 1.0
+
+def _time_unit_factor(transition_time_unit, time_unit):
+    #delays are drawn in the transition's time unit, transitions without one use the simulation's
+    if transition_time_unit == None or transition_time_unit == time_unit:
+        return 1.0
+    if transition_time_unit not in TIME_UNIT_SECONDS or time_unit not in TIME_UNIT_SECONDS:
+        raise Exception("time_unit undefined: {}.".format(transition_time_unit if transition_time_unit not in TIME_UNIT_SECONDS else time_unit))
+    return TIME_UNIT_SECONDS[transition_time_unit] / TIME_UNIT_SECONDS[time_unit]
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import hashlib
+import warnings
+import numpy as np
+import scipy.stats as st
+import scipy.special as sc
+from concurrent.futures import ProcessPoolExecutor
+
+#bump when the fitting procedure changes so that cached fits are not reused
+FIT_CACHE_VERSION = 2
+
+#distributions whose maximum likelihood estimates are closed-form
+CLOSED_FORM = ["expon", "norm", "uniform"]
+
+#size of the subsample used to prune candidates before the full fit
+PILOT_SAMPLES = 1000
+
+def fit_distribution(durations, dists, max_samples=10000, prune_factor=10.0):
+    """Best distribution of dists for durations, ranked like Fitter by the sum of squared errors between the pdf and the
+    100-bin density histogram of all durations. Returns a Fitter.get_best()-style dict {name: {param: value}}.
+
+    expon, norm and uniform are estimated in closed form. All others are fit by maximum likelihood in two passes, each
+    started from the previous estimate: first on a stratified pilot subsample of PILOT_SAMPLES durations, then, for the
+    candidates that are at most prune_factor times worse than the best one, on a stratified subsample of max_samples.
+    """
+
+    data = np.asarray(durations, dtype=np.float64)
+    if len(data) == 0:
+        raise Exception("Cannot fit a distribution to an empty sample.")
+
+    y, edges = np.histogram(data, bins=100, density=True)
+    x = (edges[:-1] + edges[1:]) / 2
+    sample = _stratified_sample(data, max_samples)
+    pilot = _stratified_sample(sample, PILOT_SAMPLES)
+
+    #----cheap first pass: closed-form estimates and pilot fits from moment-based starting values----#
+    params = {}
+    for name in dists:
+        params[name] = _initial_params(name, sample)
+        if name not in CLOSED_FORM:
+            params[name] = _mle(name, pilot, params[name])
+    errors = {name: _sum_square_error(name, params[name], x, y) for name in dists}
+    best_pilot = min(errors.values())
+
+    #----refit the remaining candidates on the full subsample----#
+    if len(pilot) < len(sample):
+        for name in dists:
+            if name in CLOSED_FORM or errors[name] > prune_factor * best_pilot:
+                continue
+            fitted = _mle(name, sample, params[name])
+            error = _sum_square_error(name, fitted, x, y)
+            if error < np.inf:
+                params[name], errors[name] = fitted, error
+
+    best = min(dists, key=lambda name: errors[name])
+    dist = getattr(st, best)
+    param_names = (dist.shapes + ", loc, scale").split(", ") if dist.shapes else ["loc", "scale"]
+
+    return {best: {param: float(value) for param, value in zip(param_names, params[best])}}
+
+def _stratified_sample(data, max_samples):
+    #evenly spaced order statistics, one per stratum of the sorted sample
+    if max_samples == None or len(data) <= max_samples:
+        return data
+    return np.sort(data)[((np.arange(max_samples) + 0.5) * len(data) / max_samples).astype(np.int64)]
+
+def _initial_params(name, x):
+    """Closed-form maximum likelihood estimates (expon, norm, uniform), moment-based starting values (gamma, lognorm,
+    weibull_min, triang) or None for other distributions."""
+
+    x_min, x_max, mean, std = x.min(), x.max(), x.mean(), x.std()
+    spread = max(x_max - x_min, abs(x_max) * 1e-6, 1e-9)
+    #shape distributions need loc below the smallest duration to have a finite likelihood
+    loc_below = x_min - 0.01 * spread
+
+    match name:
+        case "expon":
+            return (x_min, mean - x_min)
+        case "norm":
+            return (mean, std)
+        case "uniform":
+            return (x_min, x_max - x_min)
+        case "gamma":
+            skew = st.skew(x) if std > 0 else 0.0
+            if skew > 0.1:
+                a = 4 / skew**2
+                scale = std * skew / 2
+                loc = min(mean - a * scale, loc_below)
+            else:
+                loc = loc_below
+                a = ((mean - loc) / std)**2 if std > 0 else 1.0
+                scale = (mean - loc) / a
+            return (a, loc, scale)
+        case "lognorm":
+            z = np.log(x - loc_below)
+            return (max(z.std(), 1e-6), loc_below, np.exp(z.mean()))
+        case "weibull_min":
+            z = x - loc_below
+            c = (z.std() / z.mean())**-1.086 if z.std() > 0 else 1.0
+            return (c, loc_below, z.mean() / sc.gamma(1 + 1 / c))
+        case "triang":
+            return (float(np.clip(3 * (mean - x_min) / spread - 1, 0, 1)), x_min, spread)
+        case _:
+            return None
+
+def _mle(name, sample, initial):
+
+    dist = getattr(st, name)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            if initial == None:
+                return tuple(dist.fit(sample))
+            return tuple(dist.fit(sample, *initial[:-2], loc=initial[-2], scale=initial[-1]))
+        except Exception:
+            return initial
+
+def _sum_square_error(name, params, x, y):
+
+    if params == None:
+        return np.inf
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        error = np.sum((getattr(st, name).pdf(x, *params) - y)**2)
+
+    return error if np.isfinite(error) else np.inf
+
+def _timed_fit(durations, dists, max_samples, prune_factor):
+    start = time.perf_counter()
+    best = fit_distribution(durations, dists, max_samples, prune_factor)
+    return best, time.perf_counter() - start
+
+class DistributionFitter:
+
+    def __init__(self, dists, time_unit, n_workers=1, cache_dir=None, max_samples=10000, prune_factor=10.0, instrumentation=None):
+        self.dists = dists
+        self.instrumentation = instrumentation
+        self.time_unit = time_unit
+        self.n_workers = n_workers
+        self.max_samples = max_samples
+        self.prune_factor = prune_factor
+        self.cache_dir = cache_dir
+        if cache_dir != None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_key(self, durations):
+        h = hashlib.sha256()
+        h.update(np.asarray(durations, dtype=np.float64).tobytes())
+        h.update(json.dumps([FIT_CACHE_VERSION, self.dists, self.time_unit, self.max_samples, self.prune_factor]).encode())
+        return h.hexdigest()
+
+    def fit(self, samples):
+        """Fit the best distribution to every sample in {name: durations}. Returns {name: {distribution: {param: value}}}."""
+
+        fitted = {}
+        keys = {name: self.cache_key(durations) for name, durations in samples.items()}
+
+        for name in samples:
+            cached = self._load(keys[name])
+            if cached != None:
+                fitted[name] = cached
+
+        to_fit = [name for name in samples if name not in fitted]
+
+        if self.n_workers == 1 or len(to_fit) <= 1:
+            results = [_timed_fit(samples[name], self.dists, self.max_samples, self.prune_factor) for name in to_fit]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                results = list(pool.map(_timed_fit, [samples[name] for name in to_fit], [self.dists]*len(to_fit), [self.max_samples]*len(to_fit), [self.prune_factor]*len(to_fit)))
+
+        for name, (best, seconds) in zip(to_fit, results):
+            fitted[name] = best
+            self._store(keys[name], best)
+            if self.instrumentation != None:
+                #timed in the worker, so that parallel fits are reported per sample
+                self.instrumentation.record_stage("DistributionFitter", "fit", seconds, sample=name, durations=len(samples[name]), distribution=list(best)[0])
+        if self.instrumentation != None:
+            self.instrumentation.count("DistributionFitter", "fits cached", len(samples) - len(to_fit))
+
+        return fitted
+
+    def _load(self, key):
+        if self.cache_dir == None:
+            return None
+        path = os.path.join(self.cache_dir, key + ".json")
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            #unreadable entry, e.g. left by an older version, is fit again and overwritten
+            return None
+
+    def _store(self, key, best):
+        if self.cache_dir == None:
+            return
+        #written under a temporary name first, an interrupted run leaves no truncated entry behind
+        path = os.path.join(self.cache_dir, key + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(best, f)
+        os.replace(path + ".tmp", path)
+
+class SampleStatistics:
+    """Running count, mean and variance of a duration sample, and its mean and standard deviation at the last fit."""
+
+    def __init__(self, durations=[]):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.update(durations)
+        self.mark_fitted()
+
+    def update(self, durations):
+
+        x = np.asarray(durations, dtype=np.float64)
+        if len(x) == 0:
+            return
+
+        #merge the batch into the running moments (Chan et al.)
+        n_batch = len(x)
+        mean_batch = x.mean()
+        m2_batch = ((x - mean_batch)**2).sum()
+        delta = mean_batch - self.mean
+        n = self.n + n_batch
+
+        self.mean += delta * n_batch / n
+        self.m2 += m2_batch + delta**2 * self.n * n_batch / n
+        self.n = n
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def mark_fitted(self):
+        self.fitted_mean = self.mean
+        self.fitted_std = self.std
+
+    def drifted(self, threshold):
+        """True if mean or standard deviation moved by more than threshold (relative) since the last fit."""
+        return _relative_change(self.mean, self.fitted_mean) > threshold or _relative_change(self.std, self.fitted_std) > threshold
+
+def _relative_change(value, reference):
+    if reference == 0:
+        return 0.0 if value == 0 else np.inf
+    return abs(value - reference) / abs(reference)
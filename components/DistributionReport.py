@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import scipy.stats as st
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+
+distributions_dir = "output/distributions/"
+
+def render_distribution_plot(durations, distribution, title, xlabel, path):
+    """Histogram of durations with the pdf of the fitted distribution {name: {param: value}}, saved to path. Uses its own
+    Figure instead of the pyplot state machine, so plots can be rendered concurrently."""
+
+    dist_name, params = list(distribution.items())[0]
+    x = np.linspace(min(durations), max(durations), 1000)
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.hist(durations, bins=100, density=True)
+    ax.plot(x, getattr(st, dist_name).pdf(x, **params), lw=2, label=dist_name)
+    ax.legend()
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    fig.savefig(path)
+
+    return path
+
+class DistributionReport:
+    """Plots of the duration samples and fitted distributions of a ModelExtractor, rendered after extraction in a background
+    process pool. render() returns immediately, wait() blocks until all files are written and returns their paths."""
+
+    def __init__(self, samples, distributions, activities, time_unit, output_dir=distributions_dir):
+        #shallow copies, the extractor replaces samples and distributions on updates while figures may still be pending
+        self.samples = dict(samples)
+        self.distributions = dict(distributions)
+        self.activities = activities
+        self.time_unit = time_unit
+        self.output_dir = output_dir
+        self.futures = []
+
+    def figures(self):
+        """(durations, distribution, title, xlabel, path) of every sample that has durations."""
+
+        figures = []
+        for name, durations in self.samples.items():
+            if len(durations) == 0:
+                continue
+            if name == "arrival":
+                title, file_name = "Fitted arrival time distribution", "arrival_time_dist.pdf"
+            elif name in self.activities:
+                title, file_name = "Fitted activity distribution " + str(name), str(name) + "_dist.pdf"
+            elif name.startswith("fail_"):
+                title, file_name = "Fitted failure distribution " + name[len("fail_"):], name[len("fail_"):] + "failure_dist.pdf"
+            else:
+                title, file_name = "Fitted repair distribution " + name[len("repair_"):], name[len("repair_"):] + "repair_dist.pdf"
+            figures.append((durations, self.distributions[name], title, self.time_unit, os.path.join(self.output_dir, file_name)))
+
+        return figures
+
+    def render(self, n_workers=1):
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+        self.futures = [pool.submit(render_distribution_plot, *figure) for figure in self.figures()]
+        #the workers finish the submitted figures, the caller continues right away
+        pool.shutdown(wait=False)
+
+        return self
+
+    def wait(self):
+        return [future.result() for future in self.futures]
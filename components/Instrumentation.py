@@ -0,0 +1,141 @@
+import os
+import time
+import json
+import cProfile
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+
+class Instrumentation:
+    """Stage timers, counters, messages and results of the pipeline, emitted as JSON-serializable records to sinks, callables
+    taking one record (dict). Every record has a timestamp, a type ("stage", "counter", "message" or "result") and a component.
+
+    profile turns on cProfile for all stages (True) or the listed stage names; the stats of every profiled stage are dumped to
+    profile_dir and the path is added to its record. Totals per stage and counter are kept in stages and counters.
+    """
+
+    def __init__(self, sinks=None, profile=None, profile_dir="output/profiles/"):
+        self.sinks = [print_sink] if sinks == None else sinks
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self.counters = {}
+        self._profiling = False
+
+    def emit(self, record):
+        record = {"timestamp": datetime.now().isoformat(), **record}
+        for sink in self.sinks:
+            sink(record)
+        return record
+
+    def message(self, component, text, **fields):
+        """Progress message, printed by print_sink like the former print statements."""
+        return self.emit({"type": "message", "component": component, "text": text, **fields})
+
+    def result(self, component, title, values, **fields):
+        """Named block of result values {name: value}."""
+        return self.emit({"type": "result", "component": component, "title": title, "values": values, **fields})
+
+    def count(self, component, name, value=1, **fields):
+        self.counters[name] = self.counters.get(name, 0) + value
+        return self.emit({"type": "counter", "component": component, "name": name, "value": value, "total": self.counters[name], **fields})
+
+    def record_stage(self, component, name, seconds, rates=(), **fields):
+        """Stage timed elsewhere, e.g. in a worker process. For every field named in rates and present, <field>_per_second is added."""
+
+        totals = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+
+        record = {"type": "stage", "component": component, "stage": name, "seconds": seconds, **fields}
+        for field in rates:
+            if field in record:
+                record[field + "_per_second"] = record[field] / seconds if seconds > 0 else np.inf
+
+        return self.emit(record)
+
+    @contextmanager
+    def stage(self, component, name, text=None, rates=(), **fields):
+        """Time the enclosed block as stage name, announced by the message text if given. The block may add fields to the yielded
+        dict, e.g. counts for rates. If the block raises, the stage is recorded with failed set to the exception's type and the
+        exception is re-raised."""
+
+        if text != None:
+            self.message(component, text, stage=name)
+
+        fields = dict(fields)
+        profiler = None
+        #cProfile cannot nest, inner stages of a profiled stage are only timed
+        if (self.profile == True or (isinstance(self.profile, (list, tuple, set)) and name in self.profile)) and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields["failed"] = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler != None:
+                profiler.disable()
+                self._profiling = False
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = os.path.join(self.profile_dir, "{}_{}_{}.prof".format(component, "_".join(name.split()), datetime.now().strftime("%Y%m%d_%H%M%S_%f")))
+                profiler.dump_stats(path)
+                fields["profile"] = path
+            #rates of a failed stage would count unfinished work
+            self.record_stage(component, name, seconds, () if "failed" in fields else rates, **fields)
+
+    def summary(self):
+        """Totals of all stages ({stage: {calls, seconds}}) and counters so far."""
+        return {"stages": {name: dict(totals) for name, totals in self.stages.items()}, "counters": dict(self.counters)}
+
+def print_sink(record):
+    """Default sink: prints messages and result blocks like the former print statements, stages and counters are silent."""
+    match record["type"]:
+        case "message":
+            print(record["text"])
+        case "result":
+            print("--- {} --- \n".format(record["title"]))
+            for name, value in record["values"].items():
+                print("{}: {}".format(name, value))
+            print()
+
+class JSONLinesSink:
+    """Appends every record as one JSON line to path."""
+
+    def __init__(self, path, types=None):
+        self.path = path
+        self.types = types
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, record):
+        if self.types != None and record["type"] not in self.types:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=_to_json) + "\n")
+
+class MemorySink:
+    """Keeps all records in memory, e.g. for tests or notebooks."""
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def of_type(self, record_type):
+        return [record for record in self.records if record["type"] == record_type]
+
+def _to_json(value):
+    #numpy scalars and arrays, tuples of CIs, ...
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
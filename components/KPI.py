@@ -0,0 +1,86 @@
+from pyspn.components import spn
+
+TRANSITION_COUNTERS = ["n_times_fired", "time_enabled"]
+PLACE_COUNTERS = ["time_non_empty", "total_tokens"]
+
+#counter read for a KPI name if no counter is given explicitly
+TRANSITION_KPI_COUNTERS = {"production volume": "n_times_fired", "resource n times failed": "n_times_fired", "resource downtime": "time_enabled", "resource repair time": "time_enabled"}
+PLACE_KPI_COUNTERS = {"production volume": "total_tokens", "resource downtime": "time_non_empty"}
+
+class KPI:
+    """KPI read from a simulated model as the sum of one counter over a set of transitions and/or places."""
+
+    def __init__(self, name, transitions=None, places=None, counter=None):
+        self.name = name
+        self.transitions = _as_list(transitions)
+        self.places = _as_list(places)
+        self.transition_counter = counter if counter != None else TRANSITION_KPI_COUNTERS.get(name)
+        self.place_counter = counter if counter != None else PLACE_KPI_COUNTERS.get(name)
+        self.transition_indices = None
+        self.place_indices = None
+
+        if self.transitions == [] and self.places == []:
+            raise Exception("KPI {} has neither transitions nor places.".format(name))
+        if self.transitions != [] and self.transition_counter not in TRANSITION_COUNTERS:
+            raise Exception("Transition counter undefined for KPI {}: {}.".format(name, self.transition_counter))
+        if self.places != [] and self.place_counter not in PLACE_COUNTERS:
+            raise Exception("Place counter undefined for KPI {}: {}.".format(name, self.place_counter))
+
+    def resolve(self, rel_model:spn.SPN):
+        """Resolve the labels to positions in rel_model.transitions and rel_model.places once, so that value() reads the counters
+        without label lookups. Positions stay valid in copies of the model, e.g. in worker processes."""
+
+        transition_index = label_index(rel_model.transitions)
+        place_index = label_index(rel_model.places)
+
+        for label in self.transitions:
+            if label not in transition_index:
+                raise Exception("Transition of KPI {} not in model: {}.".format(self.name, label))
+        for label in self.places:
+            if label not in place_index:
+                raise Exception("Place of KPI {} not in model: {}.".format(self.name, label))
+
+        self.transition_indices = [transition_index[label] for label in self.transitions]
+        self.place_indices = [place_index[label] for label in self.places]
+
+        return self
+
+    def value(self, rel_model:spn.SPN):
+        if self.transition_indices == None:
+            self.resolve(rel_model)
+        x = 0
+        for i in self.transition_indices:
+            x += getattr(rel_model.transitions[i], self.transition_counter)
+        for i in self.place_indices:
+            x += getattr(rel_model.places[i], self.place_counter)
+        return x
+
+    def __repr__(self):
+        return "KPI({!r}, transitions={}, places={})".format(self.name, self.transitions, self.places)
+
+def _as_list(labels):
+    if labels == None:
+        return []
+    if isinstance(labels, str):
+        return [labels]
+    return list(labels)
+
+def label_index(nodes):
+    #position of the first node with each label, like get_transition_by_label/get_place_by_label
+    index = {}
+    for i, node in enumerate(nodes):
+        index.setdefault(node.label, i)
+    return index
+
+def check_kpis(kpis, rel_model:spn.SPN=None):
+    """Check that KPI names are unique and, if rel_model is given, resolve all KPI labels against it."""
+    names = [kpi.name for kpi in kpis]
+    if len(set(names)) != len(names):
+        raise Exception("KPI names must be unique: {}.".format(names))
+    if rel_model != None:
+        for kpi in kpis:
+            kpi.resolve(rel_model)
+
+def collect_kpis(rel_model, kpis):
+    """Read all kpis from one simulated replication of rel_model."""
+    return [kpi.value(rel_model) for kpi in kpis]
@@ -0,0 +1,195 @@
+import os
+import heapq
+import numpy as np
+import pandas as pd
+from math import gamma
+
+from components.LogLoader import TIMESTAMP_FORMAT
+
+class LogGenerator:
+    """Synthetic event/state logs of a CPPS line in the schema of raw_data/cs_two_station, for benchmarks on larger lines.
+
+    The MES directs every new order to one of n_stations stations (direct_to_line<s>). AGV a = (s-1) % n_agvs + 1 carries it
+    into the buffer of cell s (agv<a>_transport_to_cell<s>_buffer, at most buffer_capacity orders between transport start and
+    enter_cell<s>), the cell processes it (cell<s>_operation) and the MES logs order_completed. Every AGV and cell fails
+    failure_rate times per hour on average (Weibull times to failure) and is repaired after mttr minutes on average; a failure
+    interrupts the running activity, which ends at the failure timestamp. Durations are in minutes.
+    """
+
+    def __init__(self, n_stations=2, n_agvs=None, n_orders=10000, failure_rate=0.5, mttr=20.0, transport_time=3.0, operation_time=6.0, interarrival_time=None, buffer_capacity=3, seed=None, start="2023-06-01"):
+        self.n_stations = n_stations
+        self.n_agvs = n_stations if n_agvs == None else n_agvs
+        self.n_orders = n_orders
+        self.failure_rate = failure_rate
+        self.mttr = mttr
+        self.transport_time = transport_time
+        self.operation_time = operation_time
+        self.buffer_capacity = buffer_capacity
+        self.seed = seed
+        self.start = pd.Timestamp(start)
+
+        if self.n_agvs > self.n_stations:
+            raise Exception("More AGVs than stations: {} > {}.".format(self.n_agvs, self.n_stations))
+        if max(transport_time, operation_time) >= 30:
+            #the extractor takes activity durations modulo one hour
+            raise Exception("Activity durations must be well below 60 minutes: {}, {}.".format(transport_time, operation_time))
+
+        if interarrival_time == None:
+            #about 80% load on the bottleneck, AGVs or cells, after failures
+            availability = 1.0 if failure_rate == 0 else (60 / failure_rate) / (60 / failure_rate + mttr)
+            interarrival_time = 1 / (0.8 * availability * min(self.n_stations / operation_time, self.n_agvs / transport_time))
+        self.interarrival_time = interarrival_time
+
+    def agv(self, station):
+        return "agv{}".format((station - 1) % self.n_agvs + 1)
+
+    def capacity_relationships(self):
+        """[CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS] of the generated line, {enter event: leave event}."""
+        relationships = {}
+        for s in range(1, self.n_stations + 1):
+            relationships["{}_transport_to_cell{}_buffer".format(self.agv(s), s)] = "enter_cell{}".format(s)
+        for s in range(1, self.n_stations + 1):
+            relationships["enter_cell{}".format(s)] = "cell{}_operation".format(s)
+        return relationships
+
+    def generate(self):
+        """Simulate the line until all n_orders orders are completed. Returns (event_log, state_log) as DataFrames with the columns
+        of the csv logs, datetime timestamps and NaN event_type for MES events."""
+
+        rng = np.random.default_rng(self.seed)
+        events, states = [], []
+        heap = []
+        sequence = 0
+
+        def schedule(time, kind, *args):
+            nonlocal sequence
+            heapq.heappush(heap, (time, sequence, kind, args))
+            sequence += 1
+
+        def duration(mean, sigma=0.3):
+            #lognormal with the given mean
+            return float(rng.lognormal(np.log(mean) - sigma**2 / 2, sigma))
+
+        def time_to_failure():
+            #Weibull with shape 2 and mean 60 / failure_rate minutes
+            return float(rng.weibull(2.0)) * 60 / self.failure_rate / gamma(1.5)
+
+        stations = range(1, self.n_stations + 1)
+        resources = {self.agv(s): {"busy": None, "failed": False, "activity": 0} for s in stations}
+        resources.update({"cell{}".format(s): {"busy": None, "failed": False, "activity": 0} for s in stations})
+        served = {agv: [s for s in stations if self.agv(s) == agv] for agv in resources if agv.startswith("agv")}
+        queue = {s: [] for s in stations}
+        queue_head = {s: 0 for s in stations}
+        in_buffer = {s: 0 for s in stations}
+        delivered = {s: [] for s in stations}
+        delivered_head = {s: 0 for s in stations}
+        completed = 0
+
+        def start_activity(now, resource, order, activity, mean, end_kind, station):
+            resources[resource]["busy"] = (order, activity, station)
+            resources[resource]["activity"] += 1
+            events.append((now, order, resource, activity, "start"))
+            states.append((now, resource, "busy"))
+            schedule(now + duration(mean), end_kind, resource, resources[resource]["activity"])
+
+        def dispatch(now):
+            #cells first, entering a cell frees buffer space for the AGVs
+            for s in stations:
+                cell = "cell{}".format(s)
+                if resources[cell]["busy"] != None or resources[cell]["failed"] or delivered_head[s] == len(delivered[s]):
+                    continue
+                order = delivered[s][delivered_head[s]]
+                delivered_head[s] += 1
+                in_buffer[s] -= 1
+                events.append((now, order, "mes", "enter_cell{}".format(s), None))
+                start_activity(now, cell, order, "cell{}_operation".format(s), self.operation_time, "operation_end", s)
+            for agv, agv_stations in served.items():
+                if resources[agv]["busy"] != None or resources[agv]["failed"]:
+                    continue
+                #the longest waiting order of the AGV's stations with buffer space
+                waiting = [(queue[s][queue_head[s]][0], s) for s in agv_stations if queue_head[s] < len(queue[s]) and in_buffer[s] < self.buffer_capacity]
+                if waiting != []:
+                    arrival, s = min(waiting)
+                    order = queue[s][queue_head[s]][1]
+                    queue_head[s] += 1
+                    in_buffer[s] += 1
+                    start_activity(now, agv, order, "{}_transport_to_cell{}_buffer".format(agv, s), self.transport_time, "transport_end", s)
+
+        def end_activity(now, resource):
+            nonlocal completed
+            order, activity, s = resources[resource]["busy"]
+            resources[resource]["busy"] = None
+            events.append((now, order, resource, activity, "end"))
+            states.append((now, resource, "idle"))
+            if resource.startswith("agv"):
+                delivered[s].append(order)
+            else:
+                events.append((now, order, "mes", "order_completed", None))
+                completed += 1
+
+        #----arrivals and failure clocks----#
+        now = 0.0
+        for order in range(1, self.n_orders + 1):
+            now += float(rng.exponential(self.interarrival_time))
+            schedule(now, "arrival", order, int(rng.integers(1, self.n_stations + 1)))
+        if self.failure_rate > 0:
+            for resource in resources:
+                schedule(time_to_failure(), "failure", resource)
+
+        while heap != [] and completed < self.n_orders:
+            now, _, kind, args = heapq.heappop(heap)
+
+            match kind:
+                case "arrival":
+                    order, s = args
+                    events.append((now, order, "mes", "new_order", None))
+                    events.append((now, order, "mes", "direct_to_line{}".format(s), None))
+                    queue[s].append((now, order))
+                case "transport_end" | "operation_end":
+                    resource, activity = args
+                    #ends of activities interrupted by a failure are stale
+                    if resources[resource]["activity"] != activity or resources[resource]["busy"] == None:
+                        continue
+                    end_activity(now, resource)
+                case "failure":
+                    resource, = args
+                    if resources[resource]["busy"] != None:
+                        end_activity(now, resource)
+                    resources[resource]["failed"] = True
+                    states.append((now, resource, "failure"))
+                    schedule(now + duration(self.mttr, sigma=0.5), "repair", resource)
+                case "repair":
+                    resource, = args
+                    resources[resource]["failed"] = False
+                    states.append((now, resource, "repaired"))
+                    schedule(now + time_to_failure(), "failure", resource)
+
+            dispatch(now)
+
+        event_log = pd.DataFrame(events, columns=["timestamp", "order_id", "resource", "event", "event_type"])
+        event_log["timestamp"] = self._timestamps(event_log["timestamp"])
+        event_log["order_id"] = event_log["order_id"].astype(str)
+        state_log = pd.DataFrame(states, columns=["timestamp", "resource", "state"])
+        state_log["timestamp"] = self._timestamps(state_log["timestamp"])
+
+        return event_log, state_log
+
+    def write(self, directory, suffix=""):
+        """Generate the logs and write them to directory as event_log<suffix>.csv and state_log<suffix>.csv in the raw_data format.
+        Returns both paths."""
+
+        event_log, state_log = self.generate()
+
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for name, log in [("event_log", event_log), ("state_log", state_log)]:
+            path = os.path.join(directory, "{}{}.csv".format(name, suffix))
+            log = log.assign(timestamp=log["timestamp"].dt.strftime(TIMESTAMP_FORMAT).str[:-3])
+            log.to_csv(path, sep=";", index=False, na_rep="NA")
+            paths.append(path)
+
+        return paths
+
+    def _timestamps(self, minutes):
+        #millisecond resolution like the recorded logs
+        return self.start + pd.to_timedelta((minutes.to_numpy() * 60000).round(), unit="ms")
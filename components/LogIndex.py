@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+class LogIndex:
+    """One-pass index of an event log and a state log: sorted timestamp arrays per event, per (event, event_type) and per (resource, state),
+    and integer codes of the events and order ids of all non-end rows in log order."""
+
+    def __init__(self, event_log, state_log):
+
+        self.non_end = (event_log["event_type"]!="end").to_numpy()
+
+        non_end_log = event_log[self.non_end]
+        self.non_end_event_codes, self.event_categories = _codes(non_end_log["event"])
+        self.non_end_order_codes, self.order_categories = _codes(non_end_log["order_id"])
+        self.non_end_timestamps = non_end_log["timestamp"].to_numpy()
+        self.event_counts = non_end_log["event"].value_counts(sort=False).to_dict()
+
+        self.event_times = {event: np.sort(times.to_numpy(), kind="stable") for event, times in event_log.groupby("event", sort=False, observed=True)["timestamp"]}
+        self.event_type_times = {key: np.sort(times.to_numpy(), kind="stable") for key, times in event_log.groupby(["event", "event_type"], sort=False, observed=True)["timestamp"]}
+        self.state_times = {key: np.sort(times.to_numpy(), kind="stable") for key, times in state_log.groupby(["resource", "state"], sort=False, observed=True)["timestamp"]}
+
+    def events(self, event, event_type=None):
+        if event_type == None:
+            return self.event_times.get(event, np.array([], dtype="datetime64[ns]"))
+        return self.event_type_times.get((event, event_type), np.array([], dtype="datetime64[ns]"))
+
+    def states(self, resource, state):
+        return self.state_times.get((resource, state), np.array([], dtype="datetime64[ns]"))
+
+    def weight(self, event):
+        return self.event_counts.get(event, 0)
+
+def _codes(column):
+    #integer codes into an array of distinct values, missing values get a code of their own
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy().astype(np.int64)
+        categories = np.asarray(column.cat.categories, dtype=object)
+        if (codes < 0).any():
+            codes[codes < 0] = len(categories)
+            categories = np.append(categories, np.nan)
+        return codes, categories
+    codes, categories = pd.factorize(column, use_na_sentinel=False)
+    return codes, np.asarray(categories, dtype=object)
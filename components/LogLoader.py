@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+TIMESTAMP_FORMAT = "%d-%m-%Y %H:%M:%S.%f"
+
+#bump when the cache layout changes so that old caches are re-ingested
+LOG_CACHE_VERSION = 1
+
+class LogLoader:
+    """Streams semicolon-separated event/state logs in chunks into a columnar cache of memory-mapped NumPy arrays:
+    int64 nanosecond timestamps and int32 codes for the categorical columns. Later loads read the cache without re-parsing."""
+
+    def __init__(self, cache_dir="output/log_cache/", chunksize=1000000, timestamp_format=TIMESTAMP_FORMAT):
+        self.cache_dir = cache_dir
+        self.chunksize = chunksize
+        self.timestamp_format = timestamp_format
+
+    def load_event_log(self, path):
+        return self.load(path, categorical_columns=["order_id", "resource", "event", "event_type"])
+
+    def load_state_log(self, path):
+        return self.load(path, categorical_columns=["resource", "state"])
+
+    def load(self, path, categorical_columns):
+
+        cache = os.path.join(self.cache_dir, self.cache_key(path))
+
+        if not os.path.exists(os.path.join(cache, "meta.json")):
+            self._ingest(path, cache, categorical_columns)
+
+        return self._read(cache)
+
+    def cache_key(self, path):
+        stat = os.stat(path)
+        h = hashlib.sha256(json.dumps([LOG_CACHE_VERSION, os.path.abspath(path), stat.st_size, stat.st_mtime_ns, self.timestamp_format]).encode())
+        return os.path.splitext(os.path.basename(path))[0] + "_" + h.hexdigest()[:16]
+
+    def _ingest(self, path, cache, categorical_columns):
+
+        os.makedirs(cache, exist_ok=True)
+
+        columns = None
+        categories = {column: {} for column in categorical_columns}
+        n_rows = 0
+
+        for chunk in pd.read_csv(path, sep=";", dtype=str, chunksize=self.chunksize):
+
+            if columns == None:
+                columns = list(chunk.columns)
+                for column in columns:
+                    if column != "timestamp" and column not in categories:
+                        raise Exception("Column {} in {} is neither timestamp nor categorical.".format(column, path))
+                files = {column: open(os.path.join(cache, column + ".bin"), "wb") for column in columns}
+
+            timestamps = pd.to_datetime(chunk["timestamp"], format=self.timestamp_format).to_numpy().astype("datetime64[ns]").view(np.int64)
+            timestamps.tofile(files["timestamp"])
+
+            for column in categorical_columns:
+                #map the chunk's codes onto codes that are stable across chunks, missing values stay -1
+                codes, uniques = pd.factorize(chunk[column])
+                global_codes = np.array([categories[column].setdefault(value, len(categories[column])) for value in uniques], dtype=np.int32)
+                np.where(codes >= 0, global_codes[codes] if len(global_codes) > 0 else -1, -1).astype(np.int32).tofile(files[column])
+
+            n_rows += len(chunk)
+
+        if columns == None:
+            raise Exception("Log is empty: {}.".format(path))
+
+        for f in files.values():
+            f.close()
+
+        meta = {"columns": columns, "n_rows": n_rows, "categories": {column: list(values) for column, values in categories.items()}}
+
+        #meta.json marks a complete cache, so it is written last
+        with open(os.path.join(cache, "meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(cache, "meta.json.tmp"), os.path.join(cache, "meta.json"))
+
+    def _read(self, cache):
+
+        with open(os.path.join(cache, "meta.json")) as f:
+            meta = json.load(f)
+
+        data = {}
+        for column in meta["columns"]:
+            if column == "timestamp":
+                values = _memmap(os.path.join(cache, column + ".bin"), np.int64, meta["n_rows"])
+                data[column] = pd.Series(values.view("datetime64[ns]"))
+            else:
+                codes = _memmap(os.path.join(cache, column + ".bin"), np.int32, meta["n_rows"])
+                data[column] = pd.Categorical.from_codes(codes, categories=meta["categories"][column])
+
+        return pd.DataFrame(data, columns=meta["columns"])
+
+def _memmap(path, dtype, n_rows):
+    if n_rows == 0:
+        return np.array([], dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(n_rows,))
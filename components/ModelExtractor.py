@@ -3,195 +3,314 @@ import logging
 import pm4py
 import json
 import re
-from fitter import Fitter
-import matplotlib.pyplot as plt
+import pandas as pd
 
 from pyspn.components import spn
 
-distributions_dir = "output/distributions/"
+from components.DistributionFitter import DistributionFitter, SampleStatistics
+from components.LogIndex import LogIndex
+from components.Instrumentation import Instrumentation
+
+NO_TIMES = np.array([], dtype="datetime64[ns]")
 
 class ModelExtractor:
     
-    def __init__(self, event_log, state_log, config, logging_level=logging.CRITICAL):
+    def __init__(self, event_log, state_log, config, logging_level=logging.CRITICAL, n_workers=1, instrumentation=None):
+        self.instrumentation = Instrumentation() if instrumentation == None else instrumentation
         self.event_log = event_log
         self.state_log = state_log
         self.config = config
         self.activities = list(event_log["event"][event_log["event_type"].notnull()].unique())
         self.resources = list(state_log["resource"].unique())
+        self.index = LogIndex(event_log, state_log)
+        self.fitter = DistributionFitter(json.loads(self.config.get("DISTRIBUTIONS","dists")), self.config.get("TRANSITION_TIME_UNIT","time_unit"), n_workers=n_workers, cache_dir=self.config.get("DISTRIBUTIONS","fit_cache_dir",fallback=None), max_samples=self.config.getint("DISTRIBUTIONS","max_fit_samples",fallback=10000), prune_factor=self.config.getfloat("DISTRIBUTIONS","prune_factor",fallback=10.0), instrumentation=self.instrumentation)
+        self.rel_model = None
         #logging.basicConfig(level=logging_level)
 
-    def extract_model(self):
-        
+    def extract_model(self, export_plots=False):
+
+        instrumentation = self.instrumentation
         rel_model = spn.SPN()
-        
-        print('Discover material flow model')
-        net, im, fm = pm4py.discover_petri_net_alpha(self.event_log[self.event_log["event_type"]!="end"], activity_key='event', case_id_key='order_id', timestamp_key='timestamp')
-
-        #add places from pm4py pn to custom SPN
-        for place in net.places:
-            if "start" not in str(place) and "end" not in str(place):
-                new_place = spn.Place(label=str(place), n_tokens=0)
-                rel_model.add_place(new_place)
-
-        #add transitions from pm4py pn to custom SPN
-        for transition in net.transitions:
-            new_transition = spn.Transition(label=str(transition),t_type="I")
-            rel_model.add_transition(new_transition)
-        
-        #add arcs from pm4py pn to custom SPN
-        for arc in net.arcs:
-            if "start" not in str(arc) and "end" not in str(arc):
-                for transition in rel_model.transitions:
-                    if str(arc.source) == transition.label:
-                        rel_model.add_output_arc(transition,rel_model.get_place_by_label(str(arc.target)))
-                    if str(arc.target) == transition.label:
-                        rel_model.add_input_arc(rel_model.get_place_by_label(str(arc.source)),transition)
-
-        #rename transitions in custom SPN
-        for transition in rel_model.transitions:
-            transition.label = re.sub(r'[^\w,]', '',transition.label.split(",")[0])
-        
-        #rename palces in custom SPN
-        for place in rel_model.places:
-            place.label = re.sub(r'[^\w,]', '', place.label)
+
+        #timestamps that are not paired yet (open starts, unrepaired failures, ...) and capacity counters, carried over to update_model
+        self._pending = {}
+        self._capacity_state = {}
+        self.buffer_occupancy = {}
+
+        instrumentation.count("ModelExtractor", "events processed", len(self.event_log))
+        instrumentation.count("ModelExtractor", "states processed", len(self.state_log))
+
+        with instrumentation.stage("ModelExtractor", "alpha mining", text='Discover material flow model', rates=["events"], events=int(self.index.non_end.sum())):
+            #pm4py expects string case/activity columns, the cached logs of LogLoader are categorical
+            mining_log = self.event_log.loc[self.index.non_end, ["order_id", "event", "timestamp"]].astype({"order_id": str, "event": str})
+            net, im, fm = pm4py.discover_petri_net_alpha(mining_log, activity_key='event', case_id_key='order_id', timestamp_key='timestamp')
+
+        with instrumentation.stage("ModelExtractor", "build net") as stage:
+            #add places from pm4py pn to custom SPN
+            places = {}
+            for place in net.places:
+                if "start" not in str(place) and "end" not in str(place):
+                    new_place = spn.Place(label=str(place), n_tokens=0)
+                    rel_model.add_place(new_place)
+                    places[str(place)] = new_place
+
+            #add transitions from pm4py pn to custom SPN
+            transitions = {}
+            for transition in net.transitions:
+                new_transition = spn.Transition(label=str(transition),t_type="I")
+                rel_model.add_transition(new_transition)
+                transitions[str(transition)] = new_transition
+
+            #add arcs from pm4py pn to custom SPN
+            for arc in net.arcs:
+                if "start" not in str(arc) and "end" not in str(arc):
+                    if str(arc.source) in transitions:
+                        rel_model.add_output_arc(transitions[str(arc.source)],places.get(str(arc.target)))
+                    if str(arc.target) in transitions:
+                        rel_model.add_input_arc(places.get(str(arc.source)),transitions[str(arc.target)])
+
+            #rename transitions in custom SPN
+            for transition in rel_model.transitions:
+                transition.label = re.sub(r'[^\w,]', '',transition.label.split(",")[0])
+
+            #rename palces in custom SPN
+            for place in rel_model.places:
+                place.label = re.sub(r'[^\w,]', '', place.label)
+
+            #label -> place/transition and resource -> transitions, kept up to date while the model is built
+            self.places_by_label = {}
+            for place in rel_model.places:
+                self.places_by_label.setdefault(place.label, place)
+            self.transitions_by_label = {}
+            self.transitions_by_resource = {}
+            for transition in rel_model.transitions:
+                self.transitions_by_label.setdefault(transition.label, transition)
+                self.transitions_by_resource.setdefault(transition.label.split("_")[0], []).append(transition)
+
+            stage.update({"places": len(rel_model.places), "transitions": len(rel_model.transitions)})
 
         #----determine immediate transition firing weights----#
-        print('Determine immediate transition firing weights')
-        for transition in rel_model.transitions:
-            if transition.t_type == "I":
-                transition.weight = len(self.event_log[(self.event_log["event_type"]!="end") & (self.event_log["event"]==transition.label)])
+        with instrumentation.stage("ModelExtractor", "firing weights", text='Determine immediate transition firing weights'):
+            for transition in rel_model.transitions:
+                if transition.t_type == "I":
+                    transition.weight = self.index.weight(transition.label)
 
-        #----determine & parameterize arrival time timed transitions----#
-        print('Determine arrival transitions & fit distributions')
+        #----fit arrival, activity, failure & repair distributions----#
+        time_unit = self.config.get("TRANSITION_TIME_UNIT","time_unit")
 
-        for transition in rel_model.transitions:
-            if transition.input_arcs == []:
-                transition.t_type = "T"
-                transition.time_unit = self.config.get("TRANSITION_TIME_UNIT","time_unit")
-                transition.distribution = self._estimate_arrival_time_distribution(time_unit=transition.time_unit, export_plots=True)
+        with instrumentation.stage("ModelExtractor", "collect durations", text='Collect arrival, activity, failure and repair durations & fit distributions') as stage:
+            samples = self._collect_samples(self.index, time_unit)
+            stage["durations"] = sum(len(durations) for durations in samples.values())
 
-        #----determine & parameterize timed transtions----#
-        print('Determine timed transitions & fit distributions')
+        with instrumentation.stage("ModelExtractor", "fit distributions", distributions=len(samples)):
+            distributions = self.fitter.fit(samples)
 
-        for activity in self.activities:
-            activity_dist = self._estimate_activity_distribution(activity, time_unit=self.config.get("TRANSITION_TIME_UNIT","time_unit"), export_plots=True)
+        self.samples = samples
+        self.distributions = distributions
+        self.statistics = {name: SampleStatistics(durations) for name, durations in samples.items()}
+
+        #----determine & parameterize arrival time timed transitions----#
+        with instrumentation.stage("ModelExtractor", "arrival transitions", text='Determine arrival transitions'):
             for transition in rel_model.transitions:
-                if transition.label == activity:
+                if transition.input_arcs == []:
                     transition.t_type = "T"
-                    transition.time_unit = self.config.get("TRANSITION_TIME_UNIT","time_unit")
-                    transition.distribution = activity_dist
+                    transition.time_unit = time_unit
+                    transition.distribution = distributions["arrival"]
+
+        #----determine & parameterize timed transtions----#
+        with instrumentation.stage("ModelExtractor", "timed transitions", text='Determine timed transitions'):
+            for activity in self.activities:
+                if activity in self.transitions_by_label:
+                    transition = self.transitions_by_label[activity]
+                    transition.t_type = "T"
+                    transition.time_unit = time_unit
+                    transition.distribution = distributions[activity]
 
         #----determine capacities & add inhibitor arcs----#
         if self.config.getboolean("CAPACITY_EXTRACTION","extract_resource_capacities") == True:
-            print('Determine resource capacities/buffer sizes & add inhibitor arcs to model')
-
-            for capacaty_relation in self.config.items("CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS"):
-                current_cap = 0
-                caps = []
-                order_ids = []
-                for order_id, event in zip(self.event_log[self.event_log["event_type"]!="end"]["order_id"],self.event_log[self.event_log["event_type"]!="end"]["event"]):
-                    if capacaty_relation[0] in event:
-                        current_cap +=1
-                        caps.append(current_cap)
-                        order_ids.append(order_id)
-                    if capacaty_relation[1] in event and order_id in order_ids:
-                        current_cap -=1
-
-                for place in rel_model.places:
-                        if place.label in "{},{}".format(capacaty_relation[0],capacaty_relation[1]):
-                            transition_inhib = rel_model.get_transition_by_label(capacaty_relation[0])
-                            rel_model.add_inhibitor_arc(transition_inhib,place,max(caps))
+            with instrumentation.stage("ModelExtractor", "capacity extraction", text='Determine resource capacities/buffer sizes & add inhibitor arcs to model'):
+                for capacaty_relation in self.config.items("CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS"):
+                    max_cap = self._buffer_capacity(capacaty_relation, self.index)
+                    transition_inhib = self.transitions_by_label.get(capacaty_relation[0])
+
+                    for place in rel_model.places:
+                            if place.label in "{},{}".format(capacaty_relation[0],capacaty_relation[1]):
+                                rel_model.add_inhibitor_arc(transition_inhib,place,max_cap)
 
         #----create resource failure models----#
-        print('Create resource failure models & fit failure and repair distributions')
+        with instrumentation.stage("ModelExtractor", "failure models", text='Create resource failure models', resources=len(self.resources)):
+            for resource in self.resources:
+                self._create_resource_failure_model(resource, rel_model, distributions["fail_{}".format(resource)], distributions["repair_{}".format(resource)])
 
-        for resource in self.resources:
-            self._create_resource_failure_model(resource, rel_model, time_unit=self.config.get("TRANSITION_TIME_UNIT","time_unit"))
+        self.rel_model = rel_model
+
+        #plots are rendered in the background, after the model is returned
+        if export_plots == True:
+            self.plot_report = self.export_distribution_plots()
+
+        return rel_model
+
+    def export_distribution_plots(self, output_dir=None, n_workers=1):
+        """Start rendering the samples and fitted distributions of the last extraction/update into output_dir (default:
+        output/distributions/) in a background process pool. Returns the DistributionReport, whose wait() blocks until all files are written."""
+
+        #matplotlib is only imported when plots are requested
+        from components.DistributionReport import DistributionReport, distributions_dir
+        if output_dir == None:
+            output_dir = distributions_dir
+
+        report = DistributionReport(self.samples, self.distributions, self.activities, self.config.get("TRANSITION_TIME_UNIT","time_unit"), output_dir)
+
+        return report.render(n_workers)
+
+    def update_model(self, event_log_tail, state_log_tail, refit_threshold=None):
+        """Update the model of the last extract_model call with log rows that arrived since then.
+
+        Weights, capacities and duration samples are updated from the tail only. A distribution is refit when the mean or standard
+        deviation of its sample moved by more than refit_threshold (relative) since its last fit. New activities or resources
+        require a rediscovery of the net; then the whole model is extracted again from the accumulated logs and a new SPN is returned.
+        """
+
+        if refit_threshold == None:
+            refit_threshold = self.config.getfloat("INCREMENTAL","refit_threshold",fallback=0.05)
+
+        self.event_log = pd.concat([self.event_log, event_log_tail], ignore_index=True)
+        self.state_log = pd.concat([self.state_log, state_log_tail], ignore_index=True)
+
+        new_activities = [activity for activity in event_log_tail["event"][event_log_tail["event_type"].notnull()].unique() if activity not in self.activities]
+        new_resources = [resource for resource in state_log_tail["resource"].unique() if resource not in self.resources]
+
+        if self.rel_model == None or new_activities != [] or new_resources != []:
+            self.instrumentation.message("ModelExtractor", 'New activities/resources {}, rediscover model'.format(new_activities + new_resources))
+            self.activities = list(self.event_log["event"][self.event_log["event_type"].notnull()].unique())
+            self.resources = list(self.state_log["resource"].unique())
+            self.index = LogIndex(self.event_log, self.state_log)
+            return self.extract_model(export_plots=False)
+
+        instrumentation = self.instrumentation
+        rel_model = self.rel_model
+        tail_index = LogIndex(event_log_tail, state_log_tail)
+        instrumentation.count("ModelExtractor", "events processed", len(event_log_tail))
+        instrumentation.count("ModelExtractor", "states processed", len(state_log_tail))
+
+        with instrumentation.stage("ModelExtractor", "update firing weights", text='Update transition firing weights'):
+            for transition in rel_model.transitions:
+                transition.weight += tail_index.weight(transition.label)
+
+        if self.config.getboolean("CAPACITY_EXTRACTION","extract_resource_capacities") == True:
+            with instrumentation.stage("ModelExtractor", "update capacities", text='Update resource capacities/buffer sizes'):
+                for capacaty_relation in self.config.items("CAPACITY_EXTRACTION.CAPACITY_RELATIONSHIPS"):
+                    max_cap = self._buffer_capacity(capacaty_relation, tail_index)
+                    transition_inhib = self.transitions_by_label[capacaty_relation[0]]
+                    for arc in transition_inhib.inhibitor_arcs:
+                        if arc.from_place.label in "{},{}".format(capacaty_relation[0],capacaty_relation[1]):
+                            arc.multiplicity = max_cap
+
+        time_unit = self.config.get("TRANSITION_TIME_UNIT","time_unit")
+
+        with instrumentation.stage("ModelExtractor", "update durations", text='Update duration samples & refit drifted distributions'):
+            for name, durations in self._collect_samples(tail_index, time_unit).items():
+                self.samples[name] = self.samples[name] + durations
+                self.statistics[name].update(durations)
+
+        drifted = [name for name, statistics in self.statistics.items() if statistics.drifted(refit_threshold)]
+        with instrumentation.stage("ModelExtractor", "refit distributions", distributions=len(drifted)):
+            distributions = self.fitter.fit({name: self.samples[name] for name in drifted})
+
+        for name, distribution in distributions.items():
+            instrumentation.message("ModelExtractor", 'Refit {}: {}'.format(name, distribution))
+            self.statistics[name].mark_fitted()
+            self.distributions[name] = distribution
+            for transition in rel_model.transitions:
+                if (name == "arrival" and transition.input_arcs == []) or transition.label == name:
+                    transition.distribution = distribution
 
         return rel_model
+
+    def _collect_samples(self, index, time_unit):
+        """Duration samples of all arrival, activity, failure and repair transitions in index. Timestamps that cannot be paired
+        within index (open activity starts, failures without repair, ...) are kept in self._pending for the next call."""
+
+        samples = {"arrival": self._arrival_time_durations(index, time_unit)}
+        for activity in self.activities:
+            samples[activity] = self._activity_durations(index, activity, time_unit)
+        for resource in self.resources:
+            samples["fail_{}".format(resource)], samples["repair_{}".format(resource)] = self._resource_failure_model_durations(index, resource, time_unit)
+
+        return samples
+
+    def _buffer_capacity(self, capacaty_relation, index):
+        """Maximum occupancy of the buffer entered by capacaty_relation[0] events and left by capacaty_relation[1] events of the
+        same order. The occupancy after every enter/leave event is appended to self.buffer_occupancy["<enter>,<leave>"]."""
+
+        current_cap, order_ids, max_cap = self._capacity_state.get(capacaty_relation, (0, set(), None))
+
+        #match the relation against the distinct events only
+        event_codes = index.non_end_event_codes
+        enter = np.array([capacaty_relation[0] in str(event) for event in index.event_categories], dtype=bool)[event_codes]
+        leave = np.array([capacaty_relation[1] in str(event) for event in index.event_categories], dtype=bool)[event_codes]
+
+        #a leave event counts if its order entered at or before it, orders that entered in earlier calls always count
+        order_codes, orders = index.non_end_order_codes, index.order_categories
+        rows = np.arange(len(order_codes))
+        first_enter = np.full(len(orders), len(rows))
+        np.minimum.at(first_enter, order_codes[enter], rows[enter])
+        if len(order_ids) > 0:
+            first_enter[pd.Index(orders).isin(list(order_ids))] = -1
+        counted_leave = leave & (first_enter[order_codes] <= rows)
+
+        occupancy = current_cap + np.cumsum(enter.astype(np.int64) - counted_leave)
+        if enter.any():
+            #the maximum is taken right after entering, before a leave of the same event
+            peak = int((occupancy + counted_leave)[enter].max())
+            max_cap = peak if max_cap == None else max(max_cap, peak)
+
+        changed = enter | counted_leave
+        occupancy_series = pd.Series(occupancy[changed], index=pd.DatetimeIndex(index.non_end_timestamps[changed], name="timestamp"), name="occupancy")
+        buffer = "{},{}".format(capacaty_relation[0], capacaty_relation[1])
+        self.buffer_occupancy[buffer] = pd.concat([self.buffer_occupancy[buffer], occupancy_series]) if buffer in self.buffer_occupancy else occupancy_series
+
+        order_ids.update(orders[first_enter < len(rows)])
+        if len(occupancy) > 0:
+            current_cap = int(occupancy[-1])
+        self._capacity_state[capacaty_relation] = (current_cap, order_ids, max_cap)
+
+        return max_cap
     
    
-    def _estimate_arrival_time_distribution(self, time_unit, export_plots = True):
-
-        arrival_times = list(self.event_log[self.event_log["event"]=="new_order"]["timestamp"])
-        match time_unit:
-            case "s":
-                arrival_times_td =[(x-y).total_seconds() for x, y in zip(arrival_times[1:], arrival_times)] #.seconds
-            case "m":
-                arrival_times_td =[((x-y).total_seconds()/60)%60 for x, y in zip(arrival_times[1:], arrival_times)]
-            case "h":
-                arrival_times_td =[(x-y).total_seconds()//3600 for x, y in zip(arrival_times[1:], arrival_times)]
-            case "d":
-                arrival_times_td =[(x-y).days for x, y in zip(arrival_times[1:], arrival_times)]
-            case _:
-                raise Exception("time_unit undefined: {}.".format(time_unit))    
-
-        f = Fitter(arrival_times_td,distributions=json.loads(self.config.get("DISTRIBUTIONS","dists")))
-        f.fit()
+    def _arrival_time_durations(self, index, time_unit):
 
-        if export_plots == True:
-            f.hist()
-            f.plot_pdf(Nbest=1)
-            plt.title("Fitted arrival time distribution")
-            plt.xlabel(time_unit)
-            plt.savefig(distributions_dir + "arrival_time_dist.pdf")
-            plt.clf()
-        
-        return f.get_best()
+        arrival_times = np.concatenate((self._pending.get("arrival", NO_TIMES), index.events("new_order")))
+        self._pending["arrival"] = arrival_times[-1:]
+
+        return _to_time_unit(_seconds_between(arrival_times[1:], arrival_times[:-1]), time_unit, wrap_minutes=True)
     
-    def _estimate_activity_distribution(self, activity, time_unit, export_plots = True):
+    def _activity_durations(self, index, activity, time_unit):
 
-        start_times = []
-        end_times = []
-        failure_times = []
-        activity_durations = []
+        failure_times = index.states(activity.split("_")[0], "failure")
+        start_times = np.concatenate((self._pending.get(activity, NO_TIMES), index.events(activity, "start")))
+        end_times = index.events(activity, "end")
 
-        activity_log = self.event_log[self.event_log["event"]==activity]
-        failure_times = self.state_log[(self.state_log["resource"]==activity.split("_")[0]) & (self.state_log["state"]=="failure")]["timestamp"].reset_index(drop=True)
-        start_times = activity_log[activity_log["event_type"]=="start"]["timestamp"].reset_index(drop=True)
-        end_times = activity_log[activity_log["event_type"]=="end"]["timestamp"].reset_index(drop=True)
+        n = min(len(start_times), len(end_times))
+        self._pending[activity] = start_times[n:]
+        start_times = start_times[:n]
+        end_times = end_times[:n]
 
         #if failure timestamp is identical with "end" event_type time stamp -> remove whole start-end pair/exclude from dist fitting
-        failure_times_matches=np.where(np.isin(end_times,failure_times))
-        for index in sorted(list(failure_times_matches[0]), reverse=True):
-            del start_times[index]
-            del end_times[index]
-
-        match time_unit:
-            case "s":
-                activity_durations = [(x-y).total_seconds() for x,y in zip(end_times,start_times)]
-            case "m":
-                activity_durations = [((x-y).total_seconds()/60)%60 for x,y in zip(end_times,start_times)]
-            case "h":
-                activity_durations = [(x-y).total_seconds()//3600 for x,y in zip(end_times,start_times)]
-            case "d":
-                activity_durations = [(x-y).days for x,y in zip(end_times,start_times)]
-            case _:
-                raise Exception("time_unit undefined: {}.".format(time_unit))  
-    
-        f = Fitter(activity_durations,distributions=json.loads(self.config.get("DISTRIBUTIONS","dists")))
-        f.fit()
+        completed = ~np.isin(end_times, failure_times)
 
-        if export_plots == True:
-            f.hist()
-            f.plot_pdf(Nbest=1)
-            plt.title("Fitted activity distribution " + str(activity))
-            plt.xlabel(time_unit)
-            plt.savefig(distributions_dir + str(activity) + "_dist.pdf")
-            plt.clf()
-
-        return f.get_best()
+        return _to_time_unit(_seconds_between(end_times[completed], start_times[completed]), time_unit, wrap_minutes=True)
     
-    def _create_resource_failure_model(self, resource, rel_model, time_unit):
+    def _create_resource_failure_model(self, resource, rel_model, fail_distribution, repair_distribution):
 
         p_ok = spn.Place(label="{}_ok".format(resource),n_tokens=1)
         p_failed = spn.Place(label="{}_failed".format(resource),n_tokens=0)
 
         t_fail = spn.Transition(label="fail_{}".format(resource), t_type="T")
-        t_fail.distribution = self._estimate_resource_failure_model_distribution(resource, mode = "fail", time_unit=time_unit)
+        t_fail.distribution = fail_distribution
 
         t_repair = spn.Transition(label="repair_{}".format(resource), t_type="T")
-        t_repair.distribution = self._estimate_resource_failure_model_distribution(resource, mode = "repair", time_unit=time_unit)
+        t_repair.distribution = repair_distribution
 
         rel_model.add_place(p_ok)
         rel_model.add_place(p_failed)
@@ -199,75 +318,60 @@ class ModelExtractor:
         rel_model.add_transition(t_fail)
         rel_model.add_transition(t_repair)
 
+        for place in [p_ok, p_failed]:
+            self.places_by_label.setdefault(place.label, place)
+        for transition in [t_fail, t_repair]:
+            self.transitions_by_label.setdefault(transition.label, transition)
+
         rel_model.add_output_arc(t_repair,p_ok)
         rel_model.add_input_arc(p_ok,t_fail)
         rel_model.add_output_arc(t_fail,p_failed)
         rel_model.add_input_arc(p_failed,t_repair)
 
-        for transition in rel_model.transitions:
-            if resource == transition.label.split("_")[0]:
-                rel_model.add_inhibitor_arc(transition=rel_model.get_transition_by_label(transition.label),place=p_failed)
-
-    def _estimate_resource_failure_model_distribution(self, resource, mode, time_unit, export_plots = True):
-
-        failure_times = []
-        repair_times = []
-        durations = []
-
-        resource_state_log = self.state_log[self.state_log["resource"]==resource]
-
-        failure_times = resource_state_log[resource_state_log["state"]=="failure"]["timestamp"].tolist()
-        repair_times = resource_state_log[resource_state_log["state"]=="repaired"]["timestamp"].tolist()
-
-        if mode == "repair":
-            match time_unit:
-                case "s":
-                    durations = [(x-y).total_seconds() for x,y in zip(repair_times,failure_times)]
-                case "m":
-                    durations = [(x-y).total_seconds()/60 for x,y in zip(repair_times,failure_times)]
-                case "h":
-                    durations = [(x-y).total_seconds()//3600 for x,y in zip(repair_times,failure_times)]
-                case "d":
-                    durations = [(x-y).days for x,y in zip(repair_times,failure_times)]
-                case _:
-                    raise Exception("time_unit undefined: {}.".format(time_unit))  
-
-            f = Fitter(durations,distributions=json.loads(self.config.get("DISTRIBUTIONS","dists")))
-            f.fit()
-
-            if export_plots == True:
-                f.hist()
-                f.plot_pdf(Nbest=1)
-                plt.title("Fitted repair distribution " + str(resource))
-                plt.xlabel(time_unit)
-                plt.savefig(distributions_dir + str(resource) + "repair_dist.pdf")
-                plt.clf()
-
-        if mode == "fail":
-            
-            failure_times.pop(0)
-
-            match time_unit:
-                case "s":
-                    durations = [(x-y).total_seconds() for x,y in zip(failure_times,repair_times)]
-                case "m":
-                    durations = [(x-y).total_seconds()/60 for x,y in zip(failure_times,repair_times)]
-                case "h":
-                    durations = [(x-y).total_seconds()//3600 for x,y in zip(failure_times,repair_times)]
-                case "d":
-                    durations = [(x-y).days for x,y in zip(failure_times,repair_times)]
-                case _:
-                    raise Exception("time_unit undefined: {}.".format(time_unit))  
-
-            f = Fitter(durations,distributions=json.loads(self.config.get("DISTRIBUTIONS","dists")))
-            f.fit()
-
-            if export_plots == True:
-                f.hist()
-                f.plot_pdf(Nbest=1)
-                plt.title("Fitted failure distribution " + str(resource))
-                plt.xlabel(time_unit)
-                plt.savefig(distributions_dir + str(resource) + "failure_dist.pdf")
-                plt.clf()
-
-        return f.get_best()
+        for transition in self.transitions_by_resource.get(resource, []):
+            rel_model.add_inhibitor_arc(transition=transition,place=p_failed)
+
+    def _resource_failure_model_durations(self, index, resource, time_unit):
+
+        new_failure_times = index.states(resource, "failure")
+        repair_times = index.states(resource, "repaired")
+
+        #repair durations: i-th repair after the i-th failure
+        failure_times = np.concatenate((self._pending.get("failure_" + resource, NO_TIMES), new_failure_times))
+        n = min(len(repair_times), len(failure_times))
+        self._pending["failure_" + resource] = failure_times[n:]
+        repair_durations = _to_time_unit(_seconds_between(repair_times[:n], failure_times[:n]), time_unit)
+
+        #failure durations: each failure after the preceding repair, the very first failure of the log has none
+        previous_repairs = self._pending.get("repair_" + resource)
+        if previous_repairs is None:
+            if len(new_failure_times) == 0:
+                return [], repair_durations
+            new_failure_times = new_failure_times[1:]
+            previous_repairs = NO_TIMES
+        repair_times = np.concatenate((previous_repairs, repair_times))
+        n = min(len(new_failure_times), len(repair_times))
+        self._pending["repair_" + resource] = repair_times[n:]
+        fail_durations = _to_time_unit(_seconds_between(new_failure_times[:n], repair_times[:n]), time_unit)
+
+        return fail_durations, repair_durations
+
+def _seconds_between(later, earlier):
+    return (later - earlier) / np.timedelta64(1, "s")
+
+def _to_time_unit(seconds, time_unit, wrap_minutes=False):
+
+    match time_unit:
+        case "s":
+            durations = seconds
+        case "m":
+            #arrival and activity durations have always been taken modulo one hour in minutes
+            durations = (seconds/60)%60 if wrap_minutes else seconds/60
+        case "h":
+            durations = seconds//3600
+        case "d":
+            durations = seconds//86400
+        case _:
+            raise Exception("time_unit undefined: {}.".format(time_unit))
+
+    return durations.tolist()
@@ -1,57 +1,77 @@
 import numpy as np
-import copy
 import scipy.stats as st
+import pandas as pd
 
-from pyspn.components import spn, spn_simulate
+from pyspn.components import spn
+
+from components.KPI import KPI, check_kpis, collect_kpis
+from components.ReplicationRunner import ReplicationRunner
+from components.Instrumentation import Instrumentation
 
 class ModelManipulator:
 
-    def __init__(self, rel_model, time_unit):
+    def __init__(self, rel_model, time_unit, n_workers=1, seed=None, backend="spn", instrumentation=None):
         self.rel_model = rel_model
         self.time_unit = time_unit
+        self.instrumentation = Instrumentation() if instrumentation == None else instrumentation
+        self.runner = ReplicationRunner(time_unit, n_workers=n_workers, seed=seed, backend=backend, instrumentation=self.instrumentation)
+
+    def close(self):
+        """Shut down the worker pool of the runner."""
+        self.runner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def manipulate_model(self, results_transition, kpi, nr_replications = 10, time = 1000, transition_to_manipulate_static=None, handicap_static=None, transitions_to_manipulate_dynamic = [], handicap_range_dynamic = [1.0,1.0], step_dynamic = 0.1, type_dynamic = "reduce", precision=None, max_replications=1000, common_random_numbers=False):
+
+        results = self.manipulate_model_kpis([KPI(kpi, transitions=results_transition)], nr_replications, time, transition_to_manipulate_static, handicap_static, transitions_to_manipulate_dynamic, handicap_range_dynamic, step_dynamic, type_dynamic, precision, max_replications, common_random_numbers)
+
+        return results[kpi].to_dict()
+
+    def manipulate_model_kpis(self, kpis, nr_replications = 10, time = 1000, transition_to_manipulate_static=None, handicap_static=None, transitions_to_manipulate_dynamic = [], handicap_range_dynamic = [1.0,1.0], step_dynamic = 0.1, type_dynamic = "reduce", precision=None, max_replications=1000, common_random_numbers=False):
+        """Sweep the dynamic handicap and read all kpis from the same replications. Returns the KPI means with one row per handicap and one column per KPI, plus the number of replications per handicap.
 
-    def manipulate_model(self, results_transition, kpi, nr_replications = 10, time = 1000, transition_to_manipulate_static=None, handicap_static=None, transitions_to_manipulate_dynamic = [], handicap_range_dynamic = [1.0,1.0], step_dynamic = 0.1, type_dynamic = "reduce"):
+        All sweep points are simulated concurrently on the runner's workers. With common_random_numbers every handicap uses the same
+        seeds, which makes the differences between handicaps far less noisy than the KPI values themselves. If precision is given, every handicap runs batches of nr_replications replications until the relative CI half-width of every KPI is at most precision (or max_replications are run).
+        """
 
-        rel_model = copy.deepcopy(self.rel_model)
+        check_kpis(kpis, self.rel_model)
 
+        #one scenario per sweep point, applied per replication instead of mutating a model copy
+        static = {}
         if transition_to_manipulate_static != None:
-            trans = rel_model.get_transition_by_label(transition_to_manipulate_static)
-            trans.handicap = handicap_static
-            trans.handicap_type = "decrease"
+            static["{}.handicap".format(transition_to_manipulate_static)] = handicap_static
+            static["{}.handicap_type".format(transition_to_manipulate_static)] = "decrease"
 
-        results = {}
-        
-        for handicap in np.arange(handicap_range_dynamic[0],handicap_range_dynamic[1],step_dynamic):
+        sweep = [round(handicap,2) for handicap in np.arange(handicap_range_dynamic[0],handicap_range_dynamic[1],step_dynamic)]
+        scenarios = []
+        for handicap in sweep:
+            scenario = dict(static)
             for transition in transitions_to_manipulate_dynamic:
-                trans = rel_model.get_transition_by_label(transition)
-                if type_dynamic == "increase":
-                    trans.handicap_type = "increase"
-                elif type_dynamic == "decrease":
-                    trans.handicap_type = "decrease"
-                trans.handicap = round(handicap,2)
-
-            ci, y_mean = self.input_output_transformation(rel_model, nr_replications, time, results_transition, kpi)
-            results[round(handicap,2)] = y_mean
-
-        return results
-    
-    def input_output_transformation(self, rel_model, nr_replications, time, results_transition, kpi):    
-
-        y_r = []
-        for i in range(nr_replications):
-
-            spn_simulate.simulate(rel_model, max_time = time, start_time = 0, time_unit = self.time_unit, verbosity = 0, protocol = False)
-
-            if isinstance(results_transition, list):
-                x = 0
-                for transition in results_transition:
-                    if kpi == "resource repair time" or kpi == "resource downtime":
-                        x += rel_model.get_transition_by_label(transition).time_enabled
-                    elif kpi == "production volume":
-                        x += rel_model.get_transition_by_label(transition).n_times_fired
-                y_r.append(x)   
+                scenario["{}.handicap".format(transition)] = handicap
+                if type_dynamic in ["increase", "decrease"]:
+                    scenario["{}.handicap_type".format(transition)] = type_dynamic
+            scenarios.append(scenario)
+
+        with self.instrumentation.stage("ModelManipulator", "handicap sweep", points=len(scenarios), kpis=len(kpis), common_random_numbers=common_random_numbers):
+            y = self.runner.run_sweep(self.rel_model, scenarios, nr_replications, time, collect_kpis, (kpis,), common_random_numbers, precision, max_replications)
+
+        results = {}
+        for handicap, y_point in zip(sweep, y):
+            results[handicap] = {kpi.name: np.mean([values[i] for values in y_point]) for i, kpi in enumerate(kpis)}
+            results[handicap]["replications"] = len(y_point)
+
+        return pd.DataFrame.from_dict(results, orient="index", columns=[kpi.name for kpi in kpis] + ["replications"])
+
+    def input_output_transformation(self, rel_model, nr_replications, time, results_transition, kpi):
+
+        y_r = [values[0] for values in self.runner.run(rel_model, nr_replications, time, collect_kpis, ([KPI(kpi, transitions=results_transition).resolve(rel_model)],))]
 
         y_mean = np.mean(y_r)
         ci = st.t.interval(alpha=0.95,df=len(y_r)-1, loc=np.mean(y_r),scale=st.sem(y_r))
 
-        return ci, y_mean
\ No newline at end of file
+        return ci, y_mean
@@ -0,0 +1,57 @@
+import json
+import hashlib
+
+from pyspn.components import spn
+
+from components.KPI import TRANSITION_COUNTERS, PLACE_COUNTERS
+
+class ModelState:
+    """Per-run state of an SPN: marking, KPI counters, handicaps and inhibitor arc multiplicities (capacities). The structure
+    (places, transitions, arcs, distributions) is never copied; snapshot and restore are O(places + transitions + arcs)."""
+
+    def __init__(self, marking, place_counters, transition_counters, handicaps, capacities):
+        self.marking = marking
+        self.place_counters = place_counters
+        self.transition_counters = transition_counters
+        self.handicaps = handicaps
+        self.capacities = capacities
+
+    @classmethod
+    def snapshot(cls, rel_model:spn.SPN):
+        return cls(marking=[place.n_tokens for place in rel_model.places],
+                   place_counters={counter: [getattr(place, counter, 0) for place in rel_model.places] for counter in PLACE_COUNTERS},
+                   transition_counters={counter: [getattr(transition, counter, 0) for transition in rel_model.transitions] for counter in TRANSITION_COUNTERS},
+                   handicaps=[(transition.handicap, transition.handicap_type) for transition in rel_model.transitions],
+                   capacities=[[arc.multiplicity for arc in place.inhibitor_arcs] for place in rel_model.places])
+
+    def restore(self, rel_model:spn.SPN):
+
+        for place, n_tokens, multiplicities in zip(rel_model.places, self.marking, self.capacities):
+            place.n_tokens = n_tokens
+            for arc, multiplicity in zip(place.inhibitor_arcs, multiplicities):
+                arc.multiplicity = multiplicity
+        for counter, values in self.place_counters.items():
+            for place, value in zip(rel_model.places, values):
+                setattr(place, counter, value)
+
+        for transition, (handicap, handicap_type) in zip(rel_model.transitions, self.handicaps):
+            transition.handicap = handicap
+            transition.handicap_type = handicap_type
+        for counter, values in self.transition_counters.items():
+            for transition, value in zip(rel_model.transitions, values):
+                setattr(transition, counter, value)
+
+def model_fingerprint(rel_model:spn.SPN):
+    """Hash of everything a simulation of rel_model depends on: places with their marking, transitions with type, weight,
+    distribution, time unit and handicap, and all arcs with their multiplicities. Counters are left out."""
+
+    place_index = {id(place): p for p, place in enumerate(rel_model.places)}
+    places = [[place.label, place.n_tokens] for place in rel_model.places]
+    transitions = []
+    for transition in rel_model.transitions:
+        transitions.append([transition.label, transition.t_type, getattr(transition, "weight", None), transition.distribution, getattr(transition, "time_unit", None), transition.handicap, transition.handicap_type,
+                            [[place_index[id(arc.from_place)], arc.multiplicity] for arc in transition.input_arcs],
+                            [[place_index[id(arc.to_place)], arc.multiplicity] for arc in transition.output_arcs],
+                            [[place_index[id(arc.from_place)], arc.multiplicity] for arc in transition.inhibitor_arcs]])
+
+    return hashlib.sha256(json.dumps([places, transitions], sort_keys=True, default=float).encode()).hexdigest()[:16]
@@ -0,0 +1,62 @@
+import os
+import json
+import pickle
+import hashlib
+from datetime import datetime
+
+#bump when the extraction changes so that stored models are extracted again
+MODEL_STORE_VERSION = 1
+
+#config sections that do not influence the extracted model
+NON_MODEL_SECTIONS = ["LOGS", "MODEL_STORE", "SIMULATION", "KPIS", "MANIPULATION"]
+
+class ModelStore:
+    """Extracted SPNs on disk, keyed by a hash of the input logs and the extraction config. Logs are fingerprinted by path, size
+    and modification time like in LogLoader, so a key is computed without reading them. Every model is stored as <key>.pkl with
+    its metadata in <key>.json."""
+
+    def __init__(self, store_dir="output/model_store/"):
+        self.store_dir = store_dir
+
+    def key(self, log_paths, config):
+        logs = []
+        for path in log_paths:
+            stat = os.stat(path)
+            logs.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        sections = {section: dict(config.items(section)) for section in config.sections() if section not in NON_MODEL_SECTIONS}
+        h = hashlib.sha256(json.dumps([MODEL_STORE_VERSION, logs, sections], sort_keys=True).encode())
+        return h.hexdigest()[:16]
+
+    def load(self, key):
+        """Stored model of key, or None."""
+        path = os.path.join(self.store_dir, key + ".pkl")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def store(self, key, rel_model, **metadata):
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        #written under a temporary name first, an interrupted run leaves no truncated model behind
+        path = os.path.join(self.store_dir, key + ".pkl")
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(rel_model, f)
+        os.replace(path + ".tmp", path)
+
+        with open(os.path.join(self.store_dir, key + ".json"), "w") as f:
+            json.dump({"key": key, "version": MODEL_STORE_VERSION, "created": datetime.now().isoformat(), **metadata}, f, indent=2)
+
+        return path
+
+    def entries(self):
+        """Metadata of all stored models, oldest first."""
+        if not os.path.isdir(self.store_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.store_dir):
+            if name.endswith(".json"):
+                with open(os.path.join(self.store_dir, name)) as f:
+                    entries.append(json.load(f))
+        return sorted(entries, key=lambda entry: entry["created"])
@@ -1,175 +1,209 @@
 import numpy as np
 import statistics
-import datetime
 import scipy.stats as st
+import pandas as pd
 
-from pyspn.components import spn, spn_simulate
+from pyspn.components import spn
+
+from components.KPI import KPI, check_kpis, collect_kpis
+from components.ReplicationRunner import ReplicationRunner
+from components.CompiledSPN import IMPORTANCE_SAMPLING_DISTRIBUTIONS
+from components.Instrumentation import Instrumentation
 
 #from components.ModelManipulator import ModelManipulator
 
+TIME_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+GROUND_TRUTH_KPIS = ["production volume", "resource n times failed", "resource downtime"]
+
+class ValidationResult:
+    """Result of validate_model: simulated replications y_r with mean and CI, ground truth per window on the seen and unseen logs
+    with means and CIs. Unpacks like the former tuple (ci, y_mean, gt_ci, gt_mean, gt_ci_unseen, gt_mean_unseen)."""
+
+    def __init__(self, kpi, y_r, ci, y_mean, ground_truth, gt_ci, gt_mean, ground_truth_unseen, gt_ci_unseen, gt_mean_unseen):
+        self.kpi = kpi
+        self.y_r = y_r
+        self.ci = ci
+        self.y_mean = y_mean
+        self.ground_truth = ground_truth
+        self.gt_ci = gt_ci
+        self.gt_mean = gt_mean
+        self.ground_truth_unseen = ground_truth_unseen
+        self.gt_ci_unseen = gt_ci_unseen
+        self.gt_mean_unseen = gt_mean_unseen
+
+    def __iter__(self):
+        return iter((self.ci, self.y_mean, self.gt_ci, self.gt_mean, self.gt_ci_unseen, self.gt_mean_unseen))
+
 class ModelValidator:
 
-    def __init__(self, rel_model:spn.SPN, time_unit, event_log, state_log, event_log_unseen, state_log_unseen):
+    def __init__(self, rel_model:spn.SPN, time_unit, event_log, state_log, event_log_unseen, state_log_unseen, n_workers=1, seed=None, backend="spn", failure_bias=None, instrumentation=None):
+        """failure_bias < 1 shrinks the scale of the failure time distributions of the fail_<resource> transitions by that factor
+        (compiled backend only). Failures then occur more often and the replications are reweighted by their likelihood ratios, so
+        the estimates and CIs stay unbiased while rare failure KPIs need far fewer replications. Only expon, weibull_min and gamma
+        failure times are biased, the others are simulated unchanged."""
         self.rel_model = rel_model
         self.time_unit = time_unit
         self.event_log = event_log
         self.state_log = state_log
         self.event_log_unseen = event_log_unseen
         self.state_log_unseen = state_log_unseen
+        self.instrumentation = Instrumentation() if instrumentation == None else instrumentation
+        importance_sampling = None
+        if failure_bias != None:
+            failures = [transition for transition in rel_model.transitions if transition.label.startswith("fail_")]
+            importance_sampling = {transition.label: failure_bias for transition in failures if list(transition.distribution)[0] in IMPORTANCE_SAMPLING_DISTRIBUTIONS}
+            if importance_sampling == {}:
+                raise Exception("No failure time distribution supports importance sampling ({}).".format(", ".join(IMPORTANCE_SAMPLING_DISTRIBUTIONS)))
+            unbiased = [transition.label for transition in failures if transition.label not in importance_sampling]
+            if unbiased != []:
+                self.instrumentation.message("ModelValidator", "Failure times not biased (distribution not supported): {}".format(", ".join(unbiased)), unbiased=unbiased)
+        self.runner = ReplicationRunner(time_unit, n_workers=n_workers, seed=seed, backend=backend, importance_sampling=importance_sampling, instrumentation=self.instrumentation)
+
+    def close(self):
+        """Shut down the worker pool of the runner."""
+        self.runner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def validate_model(self, nr_replications=10, time=1000, validation_method = "IOT", results_transition=None, results_place=None, kpi=None, precision=None, max_replications=1000, steady_state=False, nr_runs=1):
+
+        """Simulate one KPI and compare it with the ground truth of the seen and unseen logs. The three result blocks are emitted
+        to the instrumentation sinks, the returned ValidationResult unpacks like (ci, y_mean, gt_ci, gt_mean, gt_ci_unseen, gt_mean_unseen)."""
+
+        y_r = self.simulate_kpis([KPI(kpi, transitions=results_transition, places=results_place)], nr_replications, time, precision, max_replications, steady_state, nr_runs)[kpi]
 
-    def validate_model(self, nr_replications=10, time=1000, validation_method = "IOT", results_transition=None, results_place=None, kpi=None):
-
-        y_r = []
-
-        for i in range(nr_replications):
-
-            rel_model = self.rel_model
-            
-            spn_simulate.simulate(rel_model, max_time = time, start_time = 0, time_unit = self.time_unit, verbosity = 0, protocol = False)
-
-            if results_transition != None:
-                if isinstance(results_transition, list):
-                    x = 0
-                    for transition in results_transition:
-                        match kpi:
-                            case "production volume" | "resource n times failed":
-                                x += rel_model.get_transition_by_label(transition).n_times_fired
-                            case "resource downtime":
-                                x += rel_model.get_transition_by_label(transition).time_enabled
-                    y_r.append(x)
-                else:
-                    match kpi: 
-                        case "production volume" | "resource n times failed":
-                            y_r.append(rel_model.get_transition_by_label(results_transition).n_times_fired)
-                        case "resource downtime":
-                            y_r.append(rel_model.get_transition_by_label(results_transition).time_enabled)                
-                
-            if results_place != None:
-                if isinstance(results_place, list):
-                    x = 0
-                    for place in results_place:
-                        match kpi:
-                            case "production volume":
-                                x += rel_model.get_place_by_label(place).total_tokens
-                            case "resource downtime":
-                                x += rel_model.get_place_by_label(place).time_non_empty
-                    y_r.append(x)
-                else:
-                    match kpi: 
-                        case "resource downtime":
-                            y_r.append(rel_model.get_place_by_label(results_transition).time_non_empty)  
-    
-        print("--- SIMULATION RESULTS --- \n")
-        print("Y: {}".format(y_r))
         y_mean = np.mean(y_r)
-        print("Mean: {}".format(y_mean))
-        y_variance = round(statistics.variance(y_r),2)
-        print("Variance: {}".format(y_variance))
-        y_stdev = round(statistics.stdev(y_r),2)
-        print("Standard deviation: {}".format(y_stdev))
         ci = st.t.interval(alpha=0.95,df=len(y_r)-1, loc=np.mean(y_r),scale=st.sem(y_r))
-        print("CI: {}\n".format(ci))
-        
-        print("--- GROUND TRUTH --- \n")
+        self.instrumentation.result("ModelValidator", "SIMULATION RESULTS", {"Replications": len(y_r), "Y": y_r, "Mean": y_mean, "Variance": round(statistics.variance(y_r),2), "Standard deviation": round(statistics.stdev(y_r),2), "CI": ci}, kpi=kpi)
+
         ground_truth, gt_ci, gt_mean = self.calculate_ground_truth(time, kpi, self.event_log, self.state_log)
-        print("Y: {}".format(ground_truth))
-        print("Mean: {}".format(gt_mean))
-        print("CI: {}\n".format(gt_ci))
+        self.instrumentation.result("ModelValidator", "GROUND TRUTH", {"Y": ground_truth, "Mean": gt_mean, "CI": gt_ci}, kpi=kpi)
 
-        print("--- GROUND TRUTH UNSEEN --- \n")
         ground_truth_unseen, gt_ci_unseen, gt_mean_unseen = self.calculate_ground_truth(time, kpi, self.event_log_unseen, self.state_log_unseen)
-        print("Y: {}".format(ground_truth_unseen))
-        print("Mean: {}".format(gt_mean_unseen))
-        print("CI: {}".format(gt_ci_unseen))
-        
-        return ci, y_mean, gt_ci, gt_mean, gt_ci_unseen, gt_mean_unseen
+        self.instrumentation.result("ModelValidator", "GROUND TRUTH UNSEEN", {"Y": ground_truth_unseen, "Mean": gt_mean_unseen, "CI": gt_ci_unseen}, kpi=kpi)
 
+        return ValidationResult(kpi, y_r, ci, y_mean, ground_truth, gt_ci, gt_mean, ground_truth_unseen, gt_ci_unseen, gt_mean_unseen)
 
-    def calculate_ground_truth(self, time, kpi, event_log, state_log):
+    def simulate_kpis(self, kpis, nr_replications=10, time=1000, precision=None, max_replications=1000, steady_state=False, nr_runs=1):
+        """Simulate nr_replications replications and read every KPI from each of them. Returns {kpi name: [y_r]}.
 
-        el_total_time = event_log["timestamp"][len(event_log["timestamp"]) - 1] - event_log["timestamp"][0]
+        If precision is given, batches of nr_replications replications are run until the relative CI half-width of every KPI is at most precision (or max_replications are run).
+        With steady_state, the replications are replaced by nr_replications batch means of length time from one long run whose warm-up is removed (see ReplicationRunner.run_batch_means), directly comparable to the ground truth windows. With nr_runs > 1, the batches are taken from nr_runs shorter runs simulated in lockstep.
+        """
 
-        match self.time_unit:
-            case "s":
-                time_multiplier = el_total_time.total_seconds() // time
-            case "m":
-                time_multiplier = int((el_total_time.total_seconds()//60) // time)
-            case "h":
-                time_multiplier = el_total_time.hours // time
-            case "d":
-                time_multiplier = el_total_time.days // time
-            case _:
-                raise Exception("time_unit undefined: {}.".format(self.time_unit))    
+        check_kpis(kpis, self.rel_model)
+        if steady_state == True:
+            if precision != None:
+                raise Exception("precision is not supported in steady-state mode.")
+            y = self.runner.run_batch_means(self.rel_model, nr_replications, time, collect_kpis, (kpis,), nr_runs)
+        elif precision == None:
+            y = self.runner.run(self.rel_model, nr_replications, time, collect_kpis, (kpis,))
+        else:
+            y = self.runner.run_until_precision(self.rel_model, nr_replications, time, collect_kpis, (kpis,), precision, max_replications)
 
-        start_time = event_log["timestamp"][0]
+        return {kpi.name: [values[i] for values in y] for i, kpi in enumerate(kpis)}
+
+    def validate_kpis(self, kpis, nr_replications=10, time=1000, precision=None, max_replications=1000, steady_state=False, nr_runs=1):
+        """Validate several KPIs on the same replications (or steady-state batches). Returns one row per KPI with the number of replications, the simulated mean/CI and the ground truth mean/CI on the seen and unseen logs."""
+
+        y = self.simulate_kpis(kpis, nr_replications, time, precision, max_replications, steady_state, nr_runs)
 
-        ground_truth = []
+        results = []
+        for kpi in kpis:
+            y_r = y[kpi.name]
+            ci = st.t.interval(alpha=0.95,df=len(y_r)-1, loc=np.mean(y_r),scale=st.sem(y_r))
+            result = {"kpi": kpi.name, "replications": len(y_r), "mean": np.mean(y_r), "stdev": statistics.stdev(y_r), "ci_low": ci[0], "ci_high": ci[1]}
 
-        print("n: {}".format(time_multiplier+1))
+            if kpi.name in GROUND_TRUTH_KPIS:
+                ground_truth, gt_ci, gt_mean = self.calculate_ground_truth(time, kpi.name, self.event_log, self.state_log)
+                ground_truth_unseen, gt_ci_unseen, gt_mean_unseen = self.calculate_ground_truth(time, kpi.name, self.event_log_unseen, self.state_log_unseen)
+                result.update({"gt_mean": gt_mean, "gt_ci_low": gt_ci[0], "gt_ci_high": gt_ci[1], "gt_mean_unseen": gt_mean_unseen, "gt_ci_low_unseen": gt_ci_unseen[0], "gt_ci_high_unseen": gt_ci_unseen[1]})
 
-        for i in range(time_multiplier+1):
+            results.append(result)
 
-            match self.time_unit:
-                case "s":
-                    end_time = start_time + datetime.timedelta(seconds=time)
-                case "m":
-                    end_time = start_time + datetime.timedelta(minutes=time)
-                case "h":
-                    end_time = start_time + datetime.timedelta(hours=time)
-                case "d":
-                    end_time = start_time + datetime.timedelta(days=time)
+        return pd.DataFrame(results).set_index("kpi")
+
+
+    def calculate_ground_truth(self, time, kpi, event_log, state_log):
+
+        if self.time_unit not in TIME_UNIT_SECONDS:
+            raise Exception("time_unit undefined: {}.".format(self.time_unit))
+
+        #all timestamps as seconds since the first event, windows are [edges[i], edges[i+1])
+        start_time = event_log["timestamp"][0]
+        window = time * TIME_UNIT_SECONDS[self.time_unit]
+        el_total_time = (event_log["timestamp"][len(event_log["timestamp"]) - 1] - start_time).total_seconds()
+        time_multiplier = int(el_total_time // window)
+        edges = np.arange(time_multiplier + 2) * window
+
+        self.instrumentation.message("ModelValidator", "n: {}".format(time_multiplier+1), windows=time_multiplier+1)
+
+        with self.instrumentation.stage("ModelValidator", "ground truth", rates=["rows"], kpi=kpi, windows=time_multiplier+1, rows=len(event_log)+len(state_log)):
+            match kpi:
+                case "production volume":
+                    completed = _seconds_since(event_log["timestamp"][event_log["event"]=="order_completed"], start_time)
+                    ground_truth = _count_per_window(completed, edges)
+                case "resource n times failed":
+                    failures = _seconds_since(state_log["timestamp"][state_log["state"]=="failure"], start_time)
+                    ground_truth = _count_per_window(failures, edges)
+                case "resource downtime":
+                    ground_truth = np.zeros(len(edges) - 1)
+                    failure_log = state_log[state_log["state"].isin(["failure", "repaired"])]
+                    for resource, resource_state_log in failure_log.groupby("resource", sort=False, observed=True):
+                        failure_times, repair_times = _failure_intervals(_seconds_since(resource_state_log["timestamp"], start_time), (resource_state_log["state"]=="failure").to_numpy(), edges)
+                        ground_truth += _overlap_per_window(failure_times, repair_times, edges) / TIME_UNIT_SECONDS[self.time_unit]
                 case _:
-                    raise Exception("time_unit undefined: {}.".format(self.time_unit))  
-
-            event_log_subset = event_log[(event_log['timestamp'] >= start_time) & (event_log['timestamp'] <= end_time)]
-            state_log_subset = state_log[(state_log['timestamp'] >= start_time) & (state_log['timestamp'] <= end_time)]            
-
-            if kpi == "production volume":
-                ground_truth.append(len(event_log_subset["event"][event_log_subset["event"]=="order_completed"]))
-            if kpi == "resource n times failed":
-                resources = list(state_log["resource"].unique())
-                total_n_times_failed = 0
-                for resource in resources:
-                    n_times_failed = 0
-                    resource_state_log = state_log_subset[state_log_subset["resource"]==resource]
-                    n_times_failed += len(resource_state_log["state"][resource_state_log["state"]=="failure"])
-                    total_n_times_failed += n_times_failed
-                ground_truth.append(total_n_times_failed)
-            if kpi == "resource downtime":
-                resources = list(state_log["resource"].unique())
-                total_system_downtime = []
-                for resource in resources:
-                    failure_times = []
-                    repair_times = []
-                    durations = []
-                    total_resource_downtime = 0
-
-                    resource_state_log = state_log_subset[state_log_subset["resource"]==resource]
-
-                    failure_times = resource_state_log[resource_state_log["state"]=="failure"]["timestamp"].tolist()
-                    repair_times = resource_state_log[resource_state_log["state"]=="repaired"]["timestamp"].tolist()
-
-                    if len(repair_times) < len(failure_times):
-                        repair_times.append(end_time)
-                    if len(failure_times) < len(repair_times):
-                        failure_times.insert(0,start_time)
-
-                    if repair_times[0] < failure_times[0]:
-
-                        failure_times.insert(0,start_time)
-                        repair_times.append(end_time) 
- 
-                    durations = [(x-y).total_seconds()/60 for x,y in zip(repair_times,failure_times)]
-                    total_resource_downtime = sum(durations)
-                    total_system_downtime.append(total_resource_downtime)
-                    
-                ground_truth.append(sum(total_system_downtime))
-            
-            start_time = end_time
-
-        ground_truth
+                    ground_truth = np.array([])
+
+        ground_truth = ground_truth.tolist()
         gt_mean = np.mean(ground_truth)
         gt_ci = st.t.interval(alpha=0.95,df=len(ground_truth)-1, loc=np.mean(ground_truth),scale=st.sem(ground_truth))
 
         return ground_truth, gt_ci, gt_mean
 
+def _seconds_since(timestamps, start_time):
+    return np.sort((timestamps - start_time).dt.total_seconds().to_numpy())
+
+def _count_per_window(times, edges):
+    return np.diff(np.searchsorted(times, edges, side="left"))
+
+def _failure_intervals(times, is_failure, edges):
+    """Pair failure/repair records of one resource into [failure, repair) intervals. Repeated records of the same state are
+    ignored, a repair without preceding failure starts at the first window and a failure without repair lasts beyond the last window."""
+
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    is_failure = is_failure[order]
+
+    changes = np.ones(len(times), dtype=bool)
+    changes[1:] = is_failure[1:] != is_failure[:-1]
+    times = times[changes]
+    is_failure = is_failure[changes]
+
+    failure_times = times[is_failure]
+    repair_times = times[~is_failure]
+
+    if len(repair_times) > 0 and (len(failure_times) == 0 or repair_times[0] < failure_times[0]):
+        failure_times = np.insert(failure_times, 0, min(edges[0], repair_times[0]))
+    if len(failure_times) > len(repair_times):
+        repair_times = np.append(repair_times, max(edges[-1], failure_times[-1]))
+
+    return failure_times, repair_times
+
+def _overlap_per_window(failure_times, repair_times, edges):
+    """Length of the union of sorted, disjoint [failure, repair) intervals falling into each window."""
+
+    #downtime accumulated up to each edge: all intervals finished before the edge plus the running part of the next one
+    completed = np.searchsorted(repair_times, edges, side="right")
+    cumulative = np.concatenate(([0], np.cumsum(repair_times - failure_times)))
+    running = np.zeros(len(edges))
+    is_running = completed < len(failure_times)
+    running[is_running] = np.clip(edges[is_running] - failure_times[completed[is_running]], 0, None)
+    downtime = cumulative[completed] + running
+
+    return np.diff(downtime)
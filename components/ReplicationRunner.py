@@ -0,0 +1,416 @@
+import json
+import random
+import numpy as np
+import scipy.stats as st
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from pyspn.components import spn, spn_simulate
+
+from components.CompiledSPN import CompiledSPN
+from components.ModelState import ModelState, model_fingerprint
+from components.KPI import label_index
+from components.Instrumentation import Instrumentation
+
+#smallest effective sample size of importance sampled replications, as a fraction of their number
+MIN_EFFECTIVE_SAMPLE_FRACTION = 0.1
+
+_worker_model = None
+_worker_state = None
+_worker_compiled = {}
+
+def _init_worker(rel_model, state):
+    #the model structure is sent once per worker, tasks only carry seeds and scenario parameters
+    global _worker_model, _worker_state, _worker_compiled
+    _worker_model = rel_model
+    _worker_state = state
+    _worker_compiled = {}
+
+def _run_replication(seed, time, time_unit, collect, collect_args, scenario=None, rel_model=None, state=None):
+
+    if rel_model == None:
+        rel_model, state = _worker_model, _worker_state
+
+    #every replication starts from the same state with its own seed, so the outcome only depends on the seed
+    state.restore(rel_model)
+    if scenario != None:
+        _apply_resolved(rel_model, scenario)
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    spn_simulate.simulate(rel_model, max_time = time, start_time = 0, time_unit = time_unit, verbosity = 0, protocol = False)
+
+    return collect(rel_model, *collect_args), sum(transition.n_times_fired for transition in rel_model.transitions), 1.0
+
+def _run_batch(scenario, seeds, time, time_unit, collect, collect_args, bias=None, compiled=None, rel_model=None, state=None):
+
+    if rel_model == None:
+        rel_model, state = _worker_model, _worker_state
+        key = _scenario_key(scenario)
+        if key not in _worker_compiled:
+            _worker_compiled[key] = _compile(rel_model, state, scenario, time_unit, bias)
+        compiled = _worker_compiled[key]
+
+    #every replication draws from streams of its own seed, its outcome does not depend on the block
+    counters = compiled.simulate(seeds, time)
+
+    results = []
+    for replication in range(len(seeds)):
+        compiled.write_counters(rel_model, counters, replication)
+        y = collect(rel_model, *collect_args)
+        if bias != None:
+            #importance sampling: the likelihood-ratio weighted values are unbiased for the original model
+            y = [value * counters["likelihood_ratio"][replication] for value in y]
+        results.append((y, int(counters["n_times_fired"][replication].sum()), float(counters["likelihood_ratio"][replication])))
+
+    return results
+
+def _compile(rel_model, state, scenario, time_unit, bias=None):
+    state.restore(rel_model)
+    if scenario != None:
+        _apply_resolved(rel_model, scenario)
+    compiled = CompiledSPN(rel_model, time_unit, bias)
+    state.restore(rel_model)
+    return compiled
+
+def _scenario_key(scenario):
+    return json.dumps(scenario, sort_keys=True, default=float)
+
+def apply_scenario(rel_model:spn.SPN, scenario):
+    """Apply scenario parameters to rel_model: "<transition>.handicap", "<transition>.handicap_type" (None keeps the current type)
+    and "<place>.capacity", the multiplicity of the inhibitor arcs leaving the place (buffer size). Callers undo it by restoring
+    a ModelState snapshot."""
+    _apply_resolved(rel_model, resolve_scenario(rel_model, scenario))
+
+def resolve_scenario(rel_model:spn.SPN, scenario):
+    """Scenario parameters as [(node kind, position, attribute, value)] with labels resolved to positions in rel_model.transitions
+    and rel_model.places, valid in every copy of the model. A handicap other than 1 whose type (from the scenario, else from the
+    model) is neither increase nor decrease would have no effect and raises an Exception."""
+
+    transition_index = label_index(rel_model.transitions)
+    place_index = label_index(rel_model.places)
+
+    resolved = []
+    for parameter, value in scenario.items():
+        label, attribute = parameter.rsplit(".", 1)
+        match attribute:
+            case "handicap" | "handicap_type":
+                if label not in transition_index:
+                    raise Exception("Transition of scenario parameter not in model: {}.".format(parameter))
+                resolved.append(("transition", transition_index[label], attribute, value))
+                #a handicap without increase/decrease type leaves the delays unchanged
+                handicap_type = scenario.get(label + ".handicap_type")
+                if handicap_type == None:
+                    handicap_type = rel_model.transitions[transition_index[label]].handicap_type
+                if attribute == "handicap" and value != None and value != 1 and handicap_type not in ["increase", "decrease"]:
+                    raise Exception("Handicap without handicap_type increase or decrease has no effect: {}.".format(parameter))
+            case "capacity":
+                if label not in place_index:
+                    raise Exception("Place of scenario parameter not in model: {}.".format(parameter))
+                resolved.append(("place", place_index[label], attribute, value))
+            case _:
+                raise Exception("Scenario parameter undefined: {}.".format(parameter))
+
+    return resolved
+
+def _apply_resolved(rel_model, resolved):
+
+    for kind, i, attribute, value in resolved:
+        if value == None:
+            continue
+        if kind == "transition":
+            setattr(rel_model.transitions[i], attribute, value)
+        else:
+            for arc in rel_model.places[i].inhibitor_arcs:
+                arc.multiplicity = value
+
+
+class ReplicationRunner:
+    """Runs independent replications of an SPN, in-process or on a pool of n_workers processes.
+
+    backend "spn" simulates every replication with spn_simulate. backend "compiled" compiles the model into a CompiledSPN and
+    simulates blocks of batch_size replications in lockstep; every replication draws from streams of its own seed, one per
+    transition, so its outcome does not depend on batch_size or n_workers.
+
+    importance_sampling {transition label: scale} (compiled backend only) draws the delays of these transitions from their scaled
+    distributions and returns every replication's collect values multiplied by its likelihood ratio, see CompiledSPN. If the
+    effective sample size (sum of the ratios)^2 / (sum of the squared ratios) of a scenario's replications is below
+    MIN_EFFECTIVE_SAMPLE_FRACTION of their number, a few replications dominate the estimate and the run raises an Exception.
+
+    Every batch of replications is reported to instrumentation as a "replications" stage with the number of replications and
+    fired transitions per second.
+
+    The worker pool is started on first use with the model and its state and reused by all later calls on the same unchanged
+    model (see model_fingerprint), any change starts a new pool. close(), or leaving the runner as a context manager, shuts it
+    down; the classes owning a runner (ModelValidator, ModelManipulator, ScenarioRunner) forward close().
+    """
+
+    def __init__(self, time_unit, n_workers=1, seed=None, backend="spn", batch_size=256, importance_sampling=None, instrumentation=None):
+        if backend not in ["spn", "compiled"]:
+            raise Exception("Simulation backend undefined: {}.".format(backend))
+        if importance_sampling != None and backend != "compiled":
+            raise Exception("Importance sampling needs the compiled backend.")
+        self.time_unit = time_unit
+        self.n_workers = n_workers
+        self.backend = backend
+        self.batch_size = batch_size
+        self.importance_sampling = importance_sampling
+        self.instrumentation = Instrumentation() if instrumentation == None else instrumentation
+        if seed == None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.nr_replications_run = 0
+        self._pool = None
+        self._pool_key = None
+
+    def close(self):
+        """Shut down the worker pool, if any."""
+        if self._pool != None:
+            self._pool.shutdown()
+        self._pool = None
+        self._pool_key = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def replication_seeds(self, first_replication, nr_replications):
+        #seed of replication i is derived from (seed, i) only, independent of the number of workers
+        return [int(np.random.SeedSequence(self.seed, spawn_key=(i,)).generate_state(1)[0]) for i in range(first_replication, first_replication + nr_replications)]
+
+    def run_until_precision(self, rel_model:spn.SPN, batch_size, time, collect, collect_args=(), precision=0.05, max_replications=1000):
+        """Run replications in batches of batch_size until the relative half-width of the 95% t-interval of every value
+        returned by collect is at most precision, or max_replications are reached. Returns the results of all replications."""
+
+        results = []
+        while len(results) < max_replications:
+            results += self.run(rel_model, min(batch_size, max_replications - len(results)), time, collect, collect_args)
+            if len(results) > 1 and all(_relative_half_width(y, self.importance_sampling != None) <= precision for y in zip(*results)):
+                break
+
+        return results
+
+    def run(self, rel_model:spn.SPN, nr_replications, time, collect, collect_args=()):
+        """Run nr_replications simulations of rel_model and return collect(rel_model, *collect_args) of each replication.
+
+        collect has to be a module-level function returning a list of KPI values so that it can be sent to the worker processes.
+        """
+
+        seeds = self.replication_seeds(self.nr_replications_run, nr_replications)
+        self.nr_replications_run += nr_replications
+
+        return self._map(rel_model, seeds, [None]*nr_replications, time, collect, collect_args)
+
+    def run_batch_means(self, rel_model:spn.SPN, nr_batches, time, collect, collect_args=(), nr_runs=1, subwindows=10, warmup_windows=2):
+        """Steady-state alternative to run: simulate nr_runs long runs (in lockstep with CompiledSPN), remove the warm-up of every
+        run with MSER and split the rest into batches of length time. Returns collect(rel_model, *collect_args) of every batch, like
+        run() does for replications.
+
+        Every run is ceil(nr_batches / nr_runs) batches plus warmup_windows windows of length time long. The warm-up is the MSER
+        truncation point of the KPI series over windows of length time / subwindows, the largest over all KPIs, within these
+        warm-up windows. If it falls into the last half window of the allowance, the warm-up may be longer: the allowance is doubled
+        and the runs are simulated again (with the same streams, so their beginnings do not change), up to the length of the batches.
+        """
+
+        if self.importance_sampling != None:
+            raise Exception("Batch means are not supported with importance sampling.")
+
+        batches_per_run = -(-nr_batches // nr_runs)
+        warmup_windows = min(warmup_windows, batches_per_run)
+
+        seeds = self.replication_seeds(self.nr_replications_run, nr_runs)
+        self.nr_replications_run += nr_runs
+
+        state = ModelState.snapshot(rel_model)
+        compiled = CompiledSPN(rel_model, self.time_unit)
+
+        while True:
+            checkpoints = np.arange(1, (batches_per_run + warmup_windows) * subwindows + 1) * time / subwindows
+            with self.instrumentation.stage("ReplicationRunner", "batch means run", rates=["fired_transitions"], backend="compiled", runs=nr_runs, time=float(checkpoints[-1])) as stage:
+                snapshots = compiled.simulate(seeds, checkpoints[-1], checkpoints=checkpoints)
+                stage["fired_transitions"] = int(snapshots["n_times_fired"][:, -1].sum())
+
+            #cumulative counters of every run at time 0 and at every checkpoint
+            cumulative = [{name: np.concatenate((np.zeros((1, values.shape[2]), dtype=values.dtype), values[run])) for name, values in snapshots.items()} for run in range(nr_runs)]
+            truncations = []
+            for run in range(nr_runs):
+                series = [_collect_window(compiled, rel_model, cumulative[run], k, k + 1, collect, collect_args) for k in range(len(checkpoints))]
+                truncations.append(max(mser_truncation(y, warmup_windows * subwindows) for y in zip(*series)))
+
+            if max(truncations) < (warmup_windows - 0.5) * subwindows or warmup_windows >= batches_per_run:
+                break
+            warmup_windows = min(2 * warmup_windows, batches_per_run)
+            self.instrumentation.message("ReplicationRunner", "Warm-up at the end of the allowance, simulating again with {} warm-up windows".format(warmup_windows), warmup_windows=warmup_windows)
+
+        results = []
+        for run, truncation in enumerate(truncations):
+            self.instrumentation.message("ReplicationRunner", "Run {}: warm-up of {} {} removed".format(run, truncation * time / subwindows, self.time_unit), run=run, warmup=truncation * time / subwindows)
+            for batch in range(batches_per_run):
+                start = truncation + batch * subwindows
+                results.append(_collect_window(compiled, rel_model, cumulative[run], start, start + subwindows, collect, collect_args))
+
+        state.restore(rel_model)
+
+        return results[:nr_batches]
+
+    def run_sweep(self, rel_model:spn.SPN, scenarios, nr_replications, time, collect, collect_args=(), common_random_numbers=False, precision=None, max_replications=1000, first_replications=None):
+        """Run nr_replications replications for every sweep point in scenarios, a list of parameter dicts for apply_scenario.
+        All replications of all points are scheduled on the pool together. Returns one list of collect results per point.
+
+        With common_random_numbers, replication i of every point uses the same seed, so that differences between points are not
+        masked by independent sampling noise. The compiled backend keeps the random numbers of every transition synchronized
+        across points; spn_simulate draws from one stream per replication, which desynchronizes once the points' paths differ.
+        With precision, points are run in batches of nr_replications like run_until_precision.
+        first_replications overrides the index of the first seed of every point.
+        """
+
+        first_replication = self.nr_replications_run
+        stride = nr_replications if precision == None else max_replications
+
+        if first_replications == None:
+            first_replications = [first_replication + (0 if common_random_numbers else point * stride) for point in range(len(scenarios))]
+
+        results = [[] for point in scenarios]
+        active = list(range(len(scenarios)))
+
+        while active != []:
+            seeds = []
+            points = []
+            for point in active:
+                n = nr_replications if precision == None else min(nr_replications, max_replications - len(results[point]))
+                seeds += self.replication_seeds(first_replications[point] + len(results[point]), n)
+                points += [point]*n
+
+            for point, y in zip(points, self._map(rel_model, seeds, [scenarios[point] for point in points], time, collect, collect_args)):
+                results[point].append(y)
+
+            if precision == None:
+                active = []
+            else:
+                active = [point for point in active if len(results[point]) < max_replications and not (len(results[point]) > 1 and all(_relative_half_width(y, self.importance_sampling != None) <= precision for y in zip(*results[point])))]
+
+        self.nr_replications_run = first_replication + (stride if common_random_numbers else stride * len(scenarios))
+
+        return results
+
+    def _map(self, rel_model, seeds, scenarios, time, collect, collect_args):
+
+        #the model is shared by all replications, only its small per-run state is reset between them
+        state = ModelState.snapshot(rel_model)
+
+        #scenario labels are resolved once per distinct scenario, workers apply them by position
+        resolved = {}
+        for scenario in scenarios:
+            key = _scenario_key(scenario)
+            if key not in resolved:
+                resolved[key] = resolve_scenario(rel_model, scenario) if scenario != None else None
+        scenarios = [resolved[_scenario_key(scenario)] for scenario in scenarios]
+
+        with self.instrumentation.stage("ReplicationRunner", "replications", rates=["replications", "fired_transitions"], backend=self.backend, replications=len(seeds), scenarios=len(resolved), time=time) as stage:
+            if self.backend == "compiled":
+                results = self._map_compiled(rel_model, state, seeds, scenarios, time, collect, collect_args)
+            elif self.n_workers == 1 or len(seeds) == 1:
+                results = [_run_replication(seed, time, self.time_unit, collect, collect_args, scenario, rel_model, state) for seed, scenario in zip(seeds, scenarios)]
+            else:
+                chunksize = max(1, len(seeds) // (4 * self.n_workers))
+                results = list(self._worker_pool(rel_model, state).map(_run_replication, seeds, repeat(time), repeat(self.time_unit), repeat(collect), repeat(collect_args), scenarios, chunksize=chunksize))
+            stage["fired_transitions"] = sum(fired for y, fired, weight in results)
+            if self.importance_sampling != None:
+                effective = _effective_sample_sizes(scenarios, [weight for y, fired, weight in results])
+                stage["effective_sample_size"] = float(min(ess for ess, n in effective.values()))
+
+        self.instrumentation.count("ReplicationRunner", "replications", len(seeds))
+
+        #leave the model as it was
+        state.restore(rel_model)
+
+        if self.importance_sampling != None:
+            for key, (ess, n) in effective.items():
+                if not ess >= MIN_EFFECTIVE_SAMPLE_FRACTION * n:
+                    raise Exception("Importance sampling weights degenerate: effective sample size {:.1f} of {} replications{}, use a bias closer to 1.".format(ess, n, "" if key == "null" else " of scenario " + key))
+
+        return [y for y, fired, weight in results]
+
+    def _map_compiled(self, rel_model, state, seeds, scenarios, time, collect, collect_args):
+
+        #replications of the same scenario share one compiled model and are split into blocks of batch_size
+        groups = {}
+        for i, scenario in enumerate(scenarios):
+            groups.setdefault(_scenario_key(scenario), []).append(i)
+
+        blocks = []
+        for indices in groups.values():
+            for start in range(0, len(indices), self.batch_size):
+                blocks.append(indices[start:start + self.batch_size])
+
+        block_scenarios = [scenarios[block[0]] for block in blocks]
+        block_seeds = [[seeds[i] for i in block] for block in blocks]
+
+        if self.n_workers == 1 or len(blocks) == 1:
+            compiled = {key: _compile(rel_model, state, scenarios[indices[0]], self.time_unit, self.importance_sampling) for key, indices in groups.items()}
+            block_results = [_run_batch(scenario, block_seed, time, self.time_unit, collect, collect_args, self.importance_sampling, compiled[_scenario_key(scenario)], rel_model, state) for scenario, block_seed in zip(block_scenarios, block_seeds)]
+        else:
+            #workers compile each scenario once from their own copy of the structure and keep it for later calls
+            block_results = list(self._worker_pool(rel_model, state).map(_run_batch, block_scenarios, block_seeds, repeat(time), repeat(self.time_unit), repeat(collect), repeat(collect_args), repeat(self.importance_sampling)))
+
+        results = [None]*len(seeds)
+        for block, y_block in zip(blocks, block_results):
+            for i, y in zip(block, y_block):
+                results[i] = y
+
+        return results
+
+    def _worker_pool(self, rel_model, state):
+        #the pool's workers hold a copy of rel_model in state, a new pool is only started if either has changed since
+        key = (id(rel_model), model_fingerprint(rel_model), vars(state))
+        if self._pool == None or self._pool_key != key:
+            self.close()
+            self._pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker, initargs=(rel_model, state))
+            self._pool_key = key
+        return self._pool
+
+def _collect_window(compiled, rel_model, cumulative, start, end, collect, collect_args):
+    #counters of the window between checkpoints start and end, read like the counters of one replication
+    compiled.write_counters(rel_model, {name: (values[end] - values[start])[None] for name, values in cumulative.items()}, 0)
+    return collect(rel_model, *collect_args)
+
+def mser_truncation(y, max_truncation):
+    """Number of leading observations of y to discard as warm-up (MSER): the d <= max_truncation minimizing the variance of
+    y[d:] divided by its length."""
+
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    d = np.arange(min(max_truncation, n - 2) + 1)
+    tail_sum = np.cumsum(y[::-1])[::-1][d]
+    tail_square_sum = np.cumsum(y[::-1]**2)[::-1][d]
+    m = n - d
+    mser = (tail_square_sum / m - (tail_sum / m)**2) / m
+
+    return int(np.argmin(mser))
+
+def _effective_sample_sizes(scenarios, weights):
+    #(effective sample size, replications) per scenario, nan if all weights are zero
+    groups = {}
+    for scenario, weight in zip(scenarios, weights):
+        groups.setdefault(_scenario_key(scenario), []).append(weight)
+    effective = {}
+    for key, w in groups.items():
+        w = np.asarray(w)
+        effective[key] = (w.sum()**2 / (w**2).sum() if (w**2).sum() > 0 else np.nan, len(w))
+    return effective
+
+def _relative_half_width(y_r, weighted=False):
+
+    y_mean = np.mean(y_r)
+    if st.sem(y_r) == 0:
+        #likelihood-ratio weighted values without variance mean collapsed weights, not a precise estimate
+        return np.inf if weighted else 0.0
+    if y_mean == 0:
+        return np.inf
+
+    ci = st.t.interval(alpha=0.95,df=len(y_r)-1, loc=y_mean,scale=st.sem(y_r))
+
+    return (ci[1] - ci[0]) / 2 / abs(y_mean)
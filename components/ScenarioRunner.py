@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+import scipy.stats as st
+import pandas as pd
+from itertools import product
+
+from pyspn.components import spn
+
+from components.KPI import check_kpis, collect_kpis
+from components.ModelState import model_fingerprint
+from components.ReplicationRunner import ReplicationRunner
+from components.Instrumentation import Instrumentation
+
+def scenario_grid(parameters):
+    """Full factorial grid of {parameter: [values]}, e.g. {"repair_agv1.handicap": [1.0, 1.5], "agv1_transport_to_cell1_buffer,enter_cell1.capacity": [2, 4]}."""
+    names = list(parameters)
+    return [dict(zip(names, values)) for values in product(*[parameters[name] for name in names])]
+
+class ScenarioRunner:
+    """Runs a batch of what-if scenarios and reports every KPI per scenario. A scenario is a dict of parameters for
+    ReplicationRunner.apply_scenario: "<transition>.handicap", "<transition>.handicap_type" and "<place>.capacity".
+
+    Without seed, the seed of the last run stored in checkpoint is reused, so that a resumed run matches its records.
+    """
+
+    def __init__(self, rel_model:spn.SPN, time_unit, n_workers=1, seed=None, checkpoint=None, backend="spn", instrumentation=None):
+        self.rel_model = rel_model
+        self.time_unit = time_unit
+        self.instrumentation = Instrumentation() if instrumentation == None else instrumentation
+        if seed == None and checkpoint != None:
+            seed = _checkpoint_seed(checkpoint)
+        self.runner = ReplicationRunner(time_unit, n_workers=n_workers, seed=seed, backend=backend, instrumentation=self.instrumentation)
+        self.checkpoint = checkpoint
+
+    def close(self):
+        """Shut down the worker pool of the runner."""
+        self.runner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, scenarios, kpis, nr_replications=10, time=1000, common_random_numbers=True, precision=None, max_replications=1000, batch_size=None):
+        """Simulate every distinct scenario and return a tidy DataFrame with one row per scenario and KPI: the scenario parameters,
+        kpi, replications, mean, stdev, ci_low and ci_high.
+
+        Scenarios are run in batches of batch_size (default: one per worker) whose replications are scheduled on the pool together.
+        Every finished batch is appended to the checkpoint file (JSON lines), so that a rerun with the same arguments skips the
+        scenarios that are already done. Seeds only depend on the position of a scenario in the deduplicated list, a resumed run
+        thus yields the same results as an uninterrupted one.
+        """
+
+        check_kpis(kpis, self.rel_model)
+
+        #drop duplicate scenarios, keeping the first occurrence
+        unique = {}
+        for scenario in scenarios:
+            unique.setdefault(_scenario_key(scenario), scenario)
+        keys = list(unique)
+
+        #records of another model, backend or time unit are not reused
+        settings = {"model": model_fingerprint(self.rel_model), "backend": self.runner.backend, "time_unit": self.time_unit, "time": time, "nr_replications": nr_replications, "common_random_numbers": common_random_numbers, "precision": precision, "max_replications": max_replications, "seed": str(self.runner.seed), "kpis": [repr(kpi) for kpi in kpis]}
+        done = self._load_checkpoint(settings)
+
+        to_run = [j for j, key in enumerate(keys) if key not in done]
+        self.instrumentation.message("ScenarioRunner", "Scenarios: {} ({} from checkpoint, {} to run)".format(len(keys), len(keys) - len(to_run), len(to_run)), scenarios=len(keys), to_run=len(to_run))
+
+        if batch_size == None:
+            batch_size = max(1, self.runner.n_workers)
+        stride = nr_replications if precision == None else max_replications
+
+        for start in range(0, len(to_run), batch_size):
+            batch = to_run[start:start + batch_size]
+
+            #with common random numbers every scenario uses the seeds of replications 0, 1, ..., otherwise scenario j owns the j-th block of seeds
+            first_replications = [0 if common_random_numbers else j * stride for j in batch]
+            y = self.runner.run_sweep(self.rel_model, [unique[keys[j]] for j in batch], nr_replications, time, collect_kpis, (kpis,), common_random_numbers, precision, max_replications, first_replications)
+
+            records = []
+            for j, y_scenario in zip(batch, y):
+                done[keys[j]] = {kpi.name: _summarize([values[i] for values in y_scenario]) for i, kpi in enumerate(kpis)}
+                records.append({"scenario": unique[keys[j]], "settings": settings, "results": done[keys[j]]})
+            self._store_checkpoint(records)
+
+            self.instrumentation.message("ScenarioRunner", "Scenarios done: {}/{}".format(len(keys) - len(to_run) + start + len(batch), len(keys)), done=len(keys) - len(to_run) + start + len(batch))
+
+        rows = []
+        for key in keys:
+            for kpi in kpis:
+                rows.append({**unique[key], "kpi": kpi.name, **done[key][kpi.name]})
+
+        return pd.DataFrame(rows)
+
+    def _load_checkpoint(self, settings):
+
+        done = {}
+        if self.checkpoint == None or not os.path.exists(self.checkpoint):
+            return done
+
+        with open(self.checkpoint) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    #a run interrupted while writing leaves a partial last line
+                    continue
+                if record["settings"] == settings:
+                    done[_scenario_key(record["scenario"])] = record["results"]
+
+        return done
+
+    def _store_checkpoint(self, records):
+
+        if self.checkpoint == None:
+            return
+
+        directory = os.path.dirname(self.checkpoint)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.checkpoint, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, default=float) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def _checkpoint_seed(checkpoint):
+    #seed of the last complete record, None if there is none yet
+    seed = None
+    if not os.path.exists(checkpoint):
+        return seed
+    with open(checkpoint) as f:
+        for line in f:
+            try:
+                seed = int(json.loads(line)["settings"]["seed"])
+            except (json.JSONDecodeError, KeyError, ValueError):
+                continue
+    return seed
+
+def _scenario_key(scenario):
+    #parameters set to None keep the model's value, numbers compare by value (2 == 2.0)
+    canonical = {parameter: (float(value) if isinstance(value, (int, float, np.number)) and not isinstance(value, bool) else value) for parameter, value in scenario.items() if value != None}
+    return json.dumps(canonical, sort_keys=True)
+
+def _summarize(y_r):
+
+    y_mean = float(np.mean(y_r))
+    if len(y_r) > 1 and st.sem(y_r) > 0:
+        ci = st.t.interval(alpha=0.95,df=len(y_r)-1, loc=y_mean,scale=st.sem(y_r))
+        stdev = float(np.std(y_r, ddof=1))
+    else:
+        ci = (y_mean, y_mean)
+        stdev = 0.0 if len(y_r) > 1 else np.nan
+
+    return {"replications": len(y_r), "mean": y_mean, "stdev": stdev, "ci_low": float(ci[0]), "ci_high": float(ci[1])}
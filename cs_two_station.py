@@ -1,5 +1,5 @@
 import configparser
-import pandas as pd
+import os
 import matplotlib.pyplot as plt
 
 from pyspn.components import spn_visualization, spn_io
@@ -7,22 +7,38 @@ from pyspn.components import spn_visualization, spn_io
 from components.ModelExtractor import ModelExtractor
 from components.ModelValidator import ModelValidator
 from components.ModelManipulator import ModelManipulator
+from components.KPI import KPI
+from components.ScenarioRunner import ScenarioRunner, scenario_grid
+from components.LogLoader import LogLoader
 
 config = configparser.ConfigParser()
 config.read('cs_two_station.ini')
 
-event_log = pd.read_csv('raw_data/cs_two_station/event_log.csv', sep=";", converters={"order_id":str}, parse_dates=["timestamp"], dayfirst=True)
-state_log = pd.read_csv('raw_data/cs_two_station/state_log.csv', sep=";", parse_dates=["timestamp"], dayfirst=True)
-event_log_unseen = pd.read_csv('raw_data/cs_two_station/event_log_unseen.csv', sep=";", converters={"order_id":str}, parse_dates=["timestamp"], dayfirst=True)
-state_log_unseen = pd.read_csv('raw_data/cs_two_station/state_log_unseen.csv', sep=";", parse_dates=["timestamp"], dayfirst=True)
+loader = LogLoader(cache_dir="output/log_cache/")
+event_log = loader.load_event_log('raw_data/cs_two_station/event_log.csv')
+state_log = loader.load_state_log('raw_data/cs_two_station/state_log.csv')
+event_log_unseen = loader.load_event_log('raw_data/cs_two_station/event_log_unseen.csv')
+state_log_unseen = loader.load_state_log('raw_data/cs_two_station/state_log_unseen.csv')
 
-mg = ModelExtractor(event_log, state_log, config)
-rel_model = mg.extract_model()
+mg = ModelExtractor(event_log, state_log, config, n_workers=os.cpu_count())
+rel_model = mg.extract_model(export_plots=True)
 
-mv = ModelValidator(rel_model,"m",event_log,state_log,event_log_unseen,state_log_unseen)
-ci, y_mean, gt_ci, gt_mean, gt_ci_unseen, gt_mean_unseen = mv.validate_model(nr_replications=100, time = 1440, results_transition="order_completed", kpi="production volume")
-ci_downtime, y_mean_downtime, gt_ci_downtime, gt_mean_downtime, gt_ci_downtime_unseen, gt_mean_downtime_unseen = mv.validate_model(nr_replications=100, time = 1440, results_transition=["repair_agv1","repair_agv2","repair_cell1","repair_cell2"], kpi="resource downtime")
+resources_repair = ["repair_agv1","repair_agv2","repair_cell1","repair_cell2"]
 
-mm = ModelManipulator(rel_model, time_unit="m")
-new_config_downtime = mm.manipulate_model(time = 1440, results_transition=["repair_agv1","repair_agv2","repair_cell1","repair_cell2"], kpi = "resource repair time", transitions_to_manipulate_dynamic=["repair_agv1","repair_agv2","repair_cell1","repair_cell2"], handicap_range_dynamic = [1.0,3.1], step_dynamic = 0.2,nr_replications=30, type_dynamic="decrease")
-new_config_prod_vol = mm.manipulate_model(time = 1440, results_transition=["order_completed"], kpi = "production volume", transitions_to_manipulate_dynamic=["repair_agv1","repair_agv2","repair_cell1","repair_cell2"], handicap_range_dynamic = [1.0,3.1], step_dynamic = 0.2,nr_replications=30, type_dynamic="decrease")
\ No newline at end of file
+mv = ModelValidator(rel_model,"m",event_log,state_log,event_log_unseen,state_log_unseen, n_workers=os.cpu_count(), seed=42)
+validation_results = mv.validate_kpis([KPI("production volume", transitions="order_completed"), KPI("resource downtime", transitions=resources_repair)], nr_replications=100, time = 1440)
+print(validation_results)
+mv.close()
+
+mm = ModelManipulator(rel_model, time_unit="m", n_workers=os.cpu_count(), seed=42)
+manipulation_results = mm.manipulate_model_kpis([KPI("resource repair time", transitions=resources_repair), KPI("production volume", transitions="order_completed")], time = 1440, transitions_to_manipulate_dynamic=resources_repair, handicap_range_dynamic = [1.0,3.1], step_dynamic = 0.2,nr_replications=30, type_dynamic="decrease", common_random_numbers=True)
+print(manipulation_results)
+mm.close()
+
+#what-if grid: repair and failure handicaps of the AGVs and faster arrivals, resumable via the checkpoint file
+sr = ScenarioRunner(rel_model, time_unit="m", n_workers=os.cpu_count(), seed=42, checkpoint="output/scenarios/cs_two_station.jsonl", backend="compiled")
+scenarios = scenario_grid({"repair_agv1.handicap": [1.0, 2.0], "repair_agv1.handicap_type": ["decrease"], "repair_agv2.handicap": [1.0, 2.0], "repair_agv2.handicap_type": ["decrease"],
+                           "fail_agv1.handicap": [1.0, 2.0], "fail_agv1.handicap_type": ["increase"], "new_order.handicap": [1.0, 1.2], "new_order.handicap_type": ["decrease"]})
+scenario_results = sr.run(scenarios, [KPI("production volume", transitions="order_completed"), KPI("resource downtime", transitions=resources_repair)], nr_replications=30, time = 1440)
+print(scenario_results)
+sr.close()
@@ -0,0 +1,163 @@
+"""Command line pipeline driven by a case study .ini config:
+
+    python3 ddra.py extract cs_two_station.ini [--force] [--plots]
+    python3 ddra.py validate cs_two_station.ini [--kpi NAME ...] [--replications N] [--time T] [--output results.csv]
+    python3 ddra.py manipulate cs_two_station.ini [--replications N] [--time T] [--output results.csv]
+
+Extracted models are kept in a model store keyed by the logs and the extraction config, validate and manipulate reuse them.
+Heavy modules (pm4py, matplotlib, scipy, the simulator) are only imported by the subcommands that need them.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import sys
+
+def load_config(path):
+    if not os.path.exists(path):
+        raise Exception("Config not found: {}.".format(path))
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+def load_logs(config, unseen=False):
+    from components.LogLoader import LogLoader
+
+    loader = LogLoader(cache_dir=config.get("LOGS", "log_cache_dir", fallback="output/log_cache/"))
+    suffix = "_unseen" if unseen else ""
+    return loader.load_event_log(config.get("LOGS", "event_log" + suffix)), loader.load_state_log(config.get("LOGS", "state_log" + suffix))
+
+def get_model(config, instrumentation, force=False, plots=False):
+    """Model of the config's logs from the store, extracted and stored if missing (or if force)."""
+    from components.ModelStore import ModelStore
+
+    store = ModelStore(config.get("MODEL_STORE", "store_dir", fallback="output/model_store/"))
+    log_paths = [config.get("LOGS", "event_log"), config.get("LOGS", "state_log")]
+    key = store.key(log_paths, config)
+
+    rel_model = None if force else store.load(key)
+    if rel_model != None:
+        instrumentation.message("ddra", "Model {} loaded from {}".format(key, store.store_dir), key=key)
+        return rel_model
+
+    from components.ModelExtractor import ModelExtractor
+
+    event_log, state_log = load_logs(config)
+    mg = ModelExtractor(event_log, state_log, config, n_workers=os.cpu_count(), instrumentation=instrumentation)
+    rel_model = mg.extract_model(export_plots=plots)
+    path = store.store(key, rel_model, logs=log_paths)
+    instrumentation.message("ddra", "Model {} stored in {}".format(key, path), key=key)
+
+    if plots == True:
+        mg.plot_report.wait()
+
+    return rel_model
+
+def config_kpis(config, names):
+    from components.KPI import KPI
+
+    if names == None or names == []:
+        names = [name for name, transitions in config.items("KPIS") if name not in config.defaults()]
+    kpis = []
+    for name in names:
+        if not config.has_option("KPIS", name):
+            raise Exception("KPI not in [KPIS] of the config: {}.".format(name))
+        kpis.append(KPI(name, transitions=[label.strip() for label in config.get("KPIS", name).split(",")]))
+    return kpis
+
+def simulation_settings(config, args, section="SIMULATION"):
+    #command line arguments override the section, the section overrides [SIMULATION]
+    def setting(name, convert, fallback):
+        if getattr(args, name) != None:
+            return getattr(args, name)
+        value = config.get(section, name, fallback=config.get("SIMULATION", name, fallback=None))
+        return fallback if value == None else convert(value)
+    return {"nr_replications": setting("nr_replications", int, 10), "time": setting("time", float, 1000), "seed": setting("seed", int, None), "backend": setting("backend", str, "spn")}
+
+def write_results(results, path):
+    if path == None:
+        return
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    if path.endswith(".json"):
+        results.to_json(path, orient="table", indent=2)
+    else:
+        results.to_csv(path)
+
+def extract(args, config, instrumentation):
+    get_model(config, instrumentation, force=args.force, plots=args.plots)
+
+def validate(args, config, instrumentation):
+    from components.ModelValidator import ModelValidator
+
+    rel_model = get_model(config, instrumentation)
+    settings = simulation_settings(config, args)
+    event_log, state_log = load_logs(config)
+    event_log_unseen, state_log_unseen = load_logs(config, unseen=True)
+
+    time_unit = config.get("TRANSITION_TIME_UNIT", "time_unit")
+    with ModelValidator(rel_model, time_unit, event_log, state_log, event_log_unseen, state_log_unseen, n_workers=args.workers, seed=settings["seed"], backend=settings["backend"], instrumentation=instrumentation) as mv:
+        results = mv.validate_kpis(config_kpis(config, args.kpi), nr_replications=settings["nr_replications"], time=settings["time"])
+
+    print(results)
+    write_results(results, args.output)
+
+def manipulate(args, config, instrumentation):
+    from components.ModelManipulator import ModelManipulator
+
+    rel_model = get_model(config, instrumentation)
+    settings = simulation_settings(config, args, section="MANIPULATION")
+    names = args.kpi if args.kpi != None else [name.strip() for name in config.get("MANIPULATION", "kpis").split(",")]
+
+    time_unit = config.get("TRANSITION_TIME_UNIT", "time_unit")
+    with ModelManipulator(rel_model, time_unit=time_unit, n_workers=args.workers, seed=settings["seed"], backend=settings["backend"], instrumentation=instrumentation) as mm:
+        results = mm.manipulate_model_kpis(config_kpis(config, names), nr_replications=settings["nr_replications"], time=settings["time"],
+                                           transitions_to_manipulate_dynamic=[label.strip() for label in config.get("MANIPULATION", "transitions").split(",")],
+                                           handicap_range_dynamic=json.loads(config.get("MANIPULATION", "handicap_range")),
+                                           step_dynamic=config.getfloat("MANIPULATION", "step"),
+                                           type_dynamic=config.get("MANIPULATION", "type", fallback="decrease"),
+                                           common_random_numbers=config.getboolean("MANIPULATION", "common_random_numbers", fallback=False))
+
+    print(results)
+    write_results(results, args.output)
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(prog="ddra", description="Data-driven reliability assessment of CPPS.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, function, help in [("extract", extract, "extract the model of the config's logs into the model store"),
+                                 ("validate", validate, "validate the KPIs of the stored model against the ground truth of the logs"),
+                                 ("manipulate", manipulate, "sweep the handicaps of [MANIPULATION] and report the KPIs")]:
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.set_defaults(function=function)
+        subparser.add_argument("config", help="case study .ini, e.g. cs_two_station.ini")
+        subparser.add_argument("--metrics", help="append instrumentation records (stages, counters, ...) as JSON lines to this file")
+        if name == "extract":
+            subparser.add_argument("--force", action="store_true", help="extract again even if the model is stored")
+            subparser.add_argument("--plots", action="store_true", help="export the distribution plots")
+        else:
+            subparser.add_argument("--kpi", action="append", help="KPI of [KPIS] (repeatable), default: all of [KPIS] resp. [MANIPULATION] kpis")
+            subparser.add_argument("--replications", dest="nr_replications", type=int, help="replications per KPI resp. handicap")
+            subparser.add_argument("--time", type=float, help="simulated time per replication in the model's time unit")
+            subparser.add_argument("--seed", type=int)
+            subparser.add_argument("--backend", choices=["spn", "compiled"])
+            subparser.add_argument("--workers", type=int, default=os.cpu_count())
+            subparser.add_argument("--output", help="write the results as .csv or .json")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+
+    args = parse_args(sys.argv[1:] if argv == None else argv)
+    config = load_config(args.config)
+
+    from components.Instrumentation import Instrumentation, JSONLinesSink, print_sink
+
+    sinks = [print_sink] if args.metrics == None else [print_sink, JSONLinesSink(args.metrics)]
+    args.function(args, config, Instrumentation(sinks=sinks))
+
+if __name__ == "__main__":
+    main()